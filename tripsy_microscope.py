@@ -1,14 +1,20 @@
 # Imports from the python standard library:
 import atexit
+import collections
 import os
-import queue
+import sys
+import shutil
+import threading
 import time
+import types
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from multiprocessing import shared_memory
 
 # Third party imports, installable via pip:
-import napari
 import numpy as np
-from tifffile import imread, imwrite
+from tifffile import imread, imwrite, memmap
 
 # Our code, one .py file per module, copy files to your local directory:
 try:
@@ -16,10 +22,13 @@ try:
     import ni_PCI_6733              # github.com/amsikking/ni_PCI_6733
     import pco_panda42_bi           # github.com/amsikking/pco_panda42_bi
     import sutter_Lambda_10_3       # github.com/amsikking/sutter_Lambda_10_3
-    from napari_in_subprocess import display    # github.com/AndrewGYork/tools
 except Exception as e:
     print('tripsy_microscope.py -> One or more imports failed')
     print('tripsy_microscope.py -> error =',e)
+try: # optional, only needed for measured memory in 'memory_report'
+    import psutil
+except ImportError:
+    psutil = None
 
 # optical configuration (edit as needed):
 epi_dichroic_mirror_options = {'488 dichroic (part#)'   :0,
@@ -46,36 +55,94 @@ class Microscope:
                  ao_rate,               # slow ~1e3, medium ~1e4, fast ~1e5
                  name='TRIPSY v1.0',
                  verbose=True,
-                 print_warnings=True):
+                 print_warnings=True,
+                 display=True):         # False = headless, no napari
         self.max_allocated_bytes = max_allocated_bytes
+        self._open_display = display # see '_init_display'
         self.name = name
         self.verbose = verbose
         self.print_warnings = print_warnings
         if self.verbose: print("%s: opening..."%self.name)
-        self.unfinished_tasks = queue.Queue()
-        # init hardware/software:
-        slow_fw_init = ct.ResultThread(
-            target=self._init_filter_wheel).start() #~5.3s
-        slow_camera_init = ct.ResultThread(
-            target=self._init_cameras).start()      #~3.6s
-        slow_lasers_init = ct.ResultThread(
-            target=self._init_lasers).start()       #~0.25s
-        self._init_display()                        #~1.3s
-        self._init_ao(ao_rate)                      #~0.2s
-        slow_lasers_init.get_result()
-        slow_camera_init.get_result()
-        slow_fw_init.get_result()
+        self.unfinished_tasks = TaskRegistry() # in flight + bounded history
+        self.inter_acquire_dead_time_s = None # ao idle time between plays
+        self._ao_idle_since_s = None
+        self.skipped_commands = {'epi_camera':0, 'tbl_camera':0, 'ao':0}
+        self.switch_time_s = 1       # updated by '_switch_microscopes'
+        self.processors = {'epi':[], 'tbl':[]} # see 'add_processor'
+        self.processing_latency_s = {} # name -> (total_s, worker_s) deque
+        self._process_pool = None
+        self.camera_rearm_time_s = 0 # updated by '_apply_camera_settings'
+        self._settings_subscribers = []
+        self._settings_version = 0
+        self.settings_snapshot = None
+        self.calibration_folder = 'calibration' # see '*_calibrate'
+        self.calibrations = {} # (path, kind, roi, exposure_us...) -> frame
+        self._correction_terms = {'epi':None, 'tbl':None} # (key, dark, gain)
+        self.stats_stride = 8 # every 8th pixel in y and x, see '_frame_stats'
+        self.stats_bins = 32
+        self.saturation_level = 2**16 - 1 # counts
+        self.frame_stats = { # time series, newest last
+            'epi':collections.deque(maxlen=1000),
+            'tbl':collections.deque(maxlen=1000)}
+        self._frame_stats_subscribers = []
+        self._shared_arrays = weakref.WeakSet() # live 'ct.SharedNDArray's
+        self._shared_arrays_lock = threading.Lock() # add vs. iterate
+        self._held_data = {} # shared memory name -> path, see 'release_data'
+        self._held_data_lock = threading.Lock()
+        self._exclusive_owner = None # thread, see '_begin_exclusive'
+        self._exclusive_changed = threading.Condition()
+        self.memory_alert_bytes = 2e9 # warn if less RAM is available
+        self.memory_monitor_period_s = 1
+        self.last_memory_report = None
+        self._child_pids = {} # name -> pid, recorded as each device opens
+        self._warned_psutil = False # see 'memory_report'
+        self.recent_max_bytes = 2e9 # RAM for 'recent_acquires' (both paths)
+        self.recent_max_acquires = 10 # per path, 0 = off
+        self.recent = {'epi':collections.deque(), 'tbl':collections.deque()}
+        self._recent_lock = threading.Lock()
+        self._recent_number = 0
+        self.write_bytes_per_s = {} # folder -> measured, see 'plan_storage'
+        self.storage_margin = 1.2 # headroom for bandwidth and free space
+        self._legal_heights_px = {} # (path, width) -> heights, see
+                                    # 'largest_height_px'
+        self.background_max_wait_s = 1 # starvation limit, see '_wait_gate'
+        self._interactive_waiting = 0 # submitted but not at the ao yet
+        self._priority_changed = threading.Condition()
+        self.queue_wait_s = { # submit -> ao custody, per priority class
+            'interactive':collections.deque(maxlen=1000),
+            'background':collections.deque(maxlen=1000)}
+        self.camera_telemetry = { # per acquire, see '_record_telemetry'
+            'epi':collections.deque(maxlen=1000),
+            'tbl':collections.deque(maxlen=1000)}
+        # init hardware/software (all at once, 'ao' needs the laser names):
+        self._init_devices({ # name: (init method, dependencies)
+            'filter_wheel': (self._init_filter_wheel, ()),  #~5.3s
+            'cameras':      (self._init_cameras, ()),       #~3.6s
+            'lasers':       (self._init_lasers, ()),        #~0.25s
+            'display':      (self._init_display, ()),       #~1.3s
+            'ao':           (lambda: self._init_ao(ao_rate),#~0.2s
+                             ('lasers',)),
+            })
         # set epi defaults:
         # -> epi_apply_settings args
         self.epi_dichroic_mirror='488 dichroic (part#)',
         self.epi_emission_filter='488 filter (part#)',
         self.epi_timestamp_mode = "binary+ASCII"
         self.epi_camera._set_timestamp_mode(self.epi_timestamp_mode)
+        self._epi_camera_state = {'timestamp_mode':self.epi_timestamp_mode}
+        self._epi_voltages_state = None
         self.epi_camera_preframes = 1 # ditch noisy frames before recording?
+        self.epi_jitter_us = self._load_jitter_us('epi') # '*_calibrate_jitter'
+        self.epi_binning = 1 # reduced in the camera process (see acquire)
+        self.epi_averaging = 1
+        self.epi_correction = "off" # dark/flat-field, see 'epi_calibrate'
         self.epi_max_bytes_per_buffer = (2**31) # legal tiff
         self.epi_max_data_buffers = 3 # camera, display, filesave
         # -> epi additional
         self.epi_num_active_data_buffers = 0
+        self._epi_data_buffers_changed = threading.Condition()
+        self._epi_data_buffer_tickets = 0 # handed out in acquire order
+        self._epi_next_data_buffer_ticket = 0
         self._epi_settings_applied = False
         # set tbl defaults:
         # -> tbl_apply_settings args
@@ -83,16 +150,124 @@ class Microscope:
         self.tbl_emission_filter='488 filter (part#)',
         self.tbl_timestamp_mode = "binary+ASCII"
         self.tbl_camera._set_timestamp_mode(self.tbl_timestamp_mode)
+        self._tbl_camera_state = {'timestamp_mode':self.tbl_timestamp_mode}
+        self._tbl_voltages_state = None
         self.tbl_camera_preframes = 1 # ditch noisy frames before recording?
+        self.tbl_jitter_us = self._load_jitter_us('tbl') # '*_calibrate_jitter'
+        self.tbl_binning = 1 # reduced in the camera process (see acquire)
+        self.tbl_averaging = 1
+        self.tbl_correction = "off" # dark/flat-field, see 'tbl_calibrate'
         self.tbl_max_bytes_per_buffer = (2**31) # legal tiff
         self.tbl_max_data_buffers = 3 # camera, display, filesave
         # -> tbl additional
         self.tbl_num_active_data_buffers = 0
+        self._tbl_data_buffers_changed = threading.Condition()
+        self._tbl_data_buffer_tickets = 0 # handed out in acquire order
+        self._tbl_next_data_buffer_ticket = 0
         self._tbl_settings_applied = False
         # switch to epi:
         self._switch_microscopes(epi_enabled=True)
+        # watch the real memory use (if we can):
+        self._memory_monitor_stop = threading.Event()
+        if psutil is not None:
+            self._baseline_rss_bytes = None
+            self.memory_report() # baseline, before any data buffers
+            self._baseline_rss_bytes = self.last_memory_report['rss_bytes']
+            self._memory_monitor = threading.Thread( # doesn't block exit
+                target=self._monitor_memory, daemon=True)
+            self._memory_monitor.start()
         if self.verbose: print("\n%s: -> open and ready."%self.name)
 
+    def subscribe_to_settings(self, callback):
+        # 'callback(snapshot)' is called from the task thread that changed the
+        # settings, so GUI callbacks should hand the snapshot to their own
+        # thread (e.g. with a queue) rather than touch widgets directly:
+        self._settings_subscribers.append(callback)
+        if self.settings_snapshot is not None:
+            callback(self.settings_snapshot)
+        return None
+
+    def unsubscribe_from_settings(self, callback):
+        self._settings_subscribers.remove(callback)
+        return None
+
+    def subscribe_to_frame_stats(self, callback):
+        # 'callback(stats)' is called from the acquire thread after every
+        # buffer (see 'subscribe_to_settings'), keep it fast:
+        self._frame_stats_subscribers.append(callback)
+        return None
+
+    def unsubscribe_from_frame_stats(self, callback):
+        self._frame_stats_subscribers.remove(callback)
+        return None
+
+    def _publish_settings(self):
+        # Immutable copy of the settings and the attributes derived from them:
+        names = ['_epi_enabled']
+        for path in ('epi', 'tbl'):
+            names.extend([
+                # -> apply_settings args
+                path + '_channels_per_image',
+                path + '_power_per_channel',
+                path + '_illumination_time_us',
+                path + '_height_px',
+                path + '_width_px',
+                path + '_timestamp_mode',
+                path + '_images_per_buffer',
+                path + '_camera_preframes',
+                path + '_binning',
+                path + '_averaging',
+                path + '_correction',
+                # -> calculated
+                path + '_bytes_per_data_buffer',
+                path + '_data_buffer_exceeded',
+                path + '_total_bytes',
+                path + '_total_bytes_exceeded',
+                path + '_buffer_time_s',
+                path + '_frames_per_s',
+                path + '_jitter_us', # calibrated
+                '_' + path + '_settings_applied',
+                ])
+        snapshot = {}
+        for n in names:
+            v = getattr(self, n, None)
+            if isinstance(v, list): v = tuple(v) # no shared mutable state
+            snapshot[n.lstrip('_')] = v
+        self._settings_version += 1
+        snapshot['version'] = self._settings_version
+        self.settings_snapshot = types.MappingProxyType(snapshot)
+        for callback in tuple(self._settings_subscribers):
+            callback(self.settings_snapshot)
+        return None
+
+    def _init_devices(self, devices):
+        # Each device starts as soon as its dependencies are open, so startup
+        # takes as long as the slowest chain rather than the sum:
+        self.init_times_s = {}
+        threads = {}
+        def init_device(name, init_method, dependencies):
+            for d in dependencies:
+                threads[d].get_result()
+            t0 = time.perf_counter()
+            init_method()
+            self.init_times_s[name] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for name, (init_method, dependencies) in devices.items():
+            for d in dependencies:
+                assert d in threads, (
+                    "%s: list '%s' before '%s'"%(self.name, d, name))
+            threads[name] = ct.ResultThread(
+                target=init_device,
+                args=(name, init_method, dependencies)).start()
+        for th in threads.values():
+            th.get_result()
+        self.init_times_s['total'] = time.perf_counter() - t0
+        if self.verbose:
+            print("\n%s: init times (s):"%self.name)
+            for name, t in self.init_times_s.items():
+                print("%s: -> %s = %0.3f"%(self.name, name, t))
+        return None
+
     def _init_filter_wheel(self):
         if self.verbose: print("\n%s: opening filter wheel..."%self.name)
 ##        self.filter_wheel = sutter_Lambda_10_3.Controller(
@@ -104,13 +279,15 @@ class Microscope:
         if self.verbose: print("\n%s: opening cameras..."%self.name)
         # init the cameras in the correct order:
         self.epi_camera = ct.ObjectInSubprocess(
-            pco_panda42_bi.Camera,
+            _open_camera, # pco_panda42_bi.Camera + '_CameraReduction'
             verbose=False,
             close_method_name='close')
+        self._child_pids['epi_camera'] = self.epi_camera.get_pid()
         self.tbl_camera = ct.ObjectInSubprocess(
-            pco_panda42_bi.Camera,
+            _open_camera, # pco_panda42_bi.Camera + '_CameraReduction'
             verbose=False,
             close_method_name='close')
+        self._child_pids['tbl_camera'] = self.tbl_camera.get_pid()
         if self.verbose: print("\n%s: -> camera open."%self.name)
 
     def _init_lasers(self):
@@ -122,7 +299,12 @@ class Microscope:
 ##        atexit.register(self.laser_box.close)
 
     def _init_display(self):
+        if not self._open_display: # headless: 'display=True' does nothing
+            self.display = _NoDisplay()
+            return None
         if self.verbose: print("\n%s: opening display..."%self.name)
+        # Imports napari, so only import if we need a display:
+        from napari_in_subprocess import display # github.com/AndrewGYork/tools
         self.display = display(display_type=_CustomNapariDisplay)
         if self.verbose: print("\n%s: -> display open."%self.name)
 
@@ -146,29 +328,32 @@ class Microscope:
             }
         if self.verbose: print("\n%s: opening ao card..."%self.name)
         self.ao = ct.ObjectInSubprocess(
-            ni_PCI_6733.DAQ,
+            _open_ao, # ni_PCI_6733.DAQ + '_SharedFloat32Voltages'
             num_channels=8,
             rate=ao_rate,
             verbose=False,
             close_method_name='close')
+        self._child_pids['ao'] = self.ao.get_pid()
+        self.ao_rate = self.ao.s2p(1) # as set by the card, see 'plan_settings'
         if self.verbose: print("\n%s: -> ao card open."%self.name)
         atexit.register(self.ao.close)
 
-    def _plot_voltages(self):
-        import matplotlib.pyplot as plt
-        # Reverse lookup table; channel numbers to names:
-        c2n = {v:k for k, v in self.names_to_voltage_channels.items()}
-        for c in range(self.voltages.shape[1]):
-            plt.plot(self.voltages[:, c], label=c2n.get(c, f'ao-{c}'))
-        plt.legend(loc='upper right')
-        xlocs, xlabels = plt.xticks()
-        plt.xticks(xlocs, [self.ao.p2s(l) for l in xlocs])
-        plt.ylabel('Volts')
-        plt.xlabel('Seconds')
-        plt.show()
+    def plot_voltages(self, path=None, max_points=2000, block=True):
+        # Inspect the epi or tbl waveform (default = current path), see
+        # the module function 'plot_voltages':
+        if path is None: path = 'epi' if self._epi_enabled else 'tbl'
+        voltages = getattr(self, path + '_voltages')
+        return plot_voltages(
+            voltages,
+            getattr(self, path + '_buffer_time_s') / voltages.shape[0],
+            self.names_to_voltage_channels,
+            title='%s %s voltages'%(self.name, path),
+            max_points=max_points,
+            block=block)
 
     def _switch_microscopes(self, epi_enabled):
         assert type(epi_enabled) is bool
+        t0 = time.perf_counter()
         if epi_enabled:
             if self.verbose:
                 print("\n%s: -> switching path to epi...."%self.name, end='')
@@ -185,14 +370,67 @@ class Microscope:
                 print("done.")
             self._tbl_update_voltages = True
             self._epi_enabled = False
+        self.switch_time_s = time.perf_counter() - t0
+        self._publish_settings()
+        return None
+
+    def _apply_camera_settings(
+        self,
+        camera,                 # ObjectInSubprocess
+        state,                  # Dict of the last applied values
+        name,                   # 'skipped_commands' key
+        roi_px,
+        illumination_time_us,
+        timestamp_mode):
+        # 'state' is the shadow of what was last sent to 'camera', so repeat
+        # or partial settings only send the commands that change something:
+        sent = 0
+        t0 = time.perf_counter()
+        roi_changed = state.get('roi_px') != roi_px
+        if roi_changed:
+            camera._disarm()
+            camera._set_roi(roi_px) # height_px updated
+            state['roi_px'] = roi_px
+            state['rolling_time_us'] = camera.rolling_time_us
+            sent += 2
+        exposure_us = int(illumination_time_us + state['rolling_time_us'])
+        exposure_changed = state.get('exposure_us') != exposure_us
+        if exposure_changed:
+            if not roi_changed:
+                camera._disarm()
+                sent += 1
+            camera._set_exposure_time_us(exposure_us)
+            state['exposure_us'] = exposure_us
+            sent += 1
+        if roi_changed or exposure_changed:
+            state['num_buffers'] = camera._num_buffers # for telemetry
+            camera._arm(state['num_buffers'])
+            sent += 1
+            self.camera_rearm_time_s = time.perf_counter() - t0
+        if state.get('timestamp_mode') != timestamp_mode:
+            camera._set_timestamp_mode(timestamp_mode)
+            state['timestamp_mode'] = timestamp_mode
+            sent += 1
+        self.skipped_commands[name] += 5 - sent # 5 commands max
         return None
 
     def _epi_check_memory(self):
         # Data:
         self.epi_images = self.epi_images_per_buffer * len(
             self.epi_channels_per_image)
-        self.epi_bytes_per_data_buffer = (
-            2 * self.epi_images * self.epi_height_px * self.epi_width_px)
+        bytes_per_px = 4 if self.epi_correction == "float32" else 2
+        (self.epi_bytes_per_data_buffer, # after binning and averaging
+         self.epi_raw_bytes,             # the camera's, if reduced
+         self.epi_bytes_per_slot,        # + uint16 source if float32
+         self.epi_total_bytes) = (int(b) for b in _buffer_bytes(
+             self.epi_height_px,
+             self.epi_width_px,
+             self.epi_images,
+             self.epi_camera_preframes,
+             self.epi_binning,
+             self.epi_averaging,
+             bytes_per_px,
+             self.epi_max_data_buffers))
         self.epi_data_buffer_exceeded = False
         if self.epi_bytes_per_data_buffer > self.epi_max_bytes_per_buffer:
             self.epi_data_buffer_exceeded = True
@@ -201,9 +439,7 @@ class Microscope:
                 print("%s: -> epi_data_buffer_exceeded"%self.name)
                 print("%s: -> reduce settings"%self.name +
                       " or increase 'epi_max_bytes_per_buffer'")
-        # Total:
-        self.epi_total_bytes = (
-            self.epi_bytes_per_data_buffer * self.epi_max_data_buffers)
+        # Total (with the camera's private raw buffer, if reduced):
         self.epi_total_bytes_exceeded = False
         if self.epi_total_bytes > self.max_allocated_bytes:
             self.epi_total_bytes_exceeded = True
@@ -219,39 +455,35 @@ class Microscope:
         # Timing information:
         exposure_px = self.ao.s2p(1e-6 * self.epi_camera.exposure_us)
         rolling_px =  self.ao.s2p(1e-6 * self.epi_camera.rolling_time_us)
-        jitter_px = max(self.ao.s2p(1000e-6), 1)
+        jitter_px = max(self.ao.s2p(1e-6 * self.epi_jitter_us), 1)
         period_px = max(exposure_px, rolling_px) + jitter_px
-        # Calculate voltages:
-        voltages = []
-        # Add preframes (if any):
-        for frames in range(self.epi_camera_preframes):
-            v = np.zeros((period_px, self.ao.num_channels), 'float64')
-            v[:rolling_px,
-              n2c['epi_camera_TTL']] = 5 # falling edge-> light on!
-            voltages.append(v)
-        for images in range(self.epi_images_per_buffer):
-            for channel, power in zip(self.epi_channels_per_image,
-                                      self.epi_power_per_channel):
-                v = np.zeros((period_px, self.ao.num_channels), 'float64')
-                v[:rolling_px,
-                  n2c['epi_camera_TTL']] = 5 # falling edge-> light on!
-                v[rolling_px:period_px - jitter_px,
-                  n2c[channel + '_power']] = 4.5 * power / 100
-                voltages.append(v)
-        voltages = np.concatenate(voltages, axis=0)
+        # Calculate voltages, in place in float32 shared memory (the ao
+        # process maps it by name, so nothing is pickled or copied):
+        ch = len(self.epi_channels_per_image)
+        frames = self.epi_camera_preframes + self.epi_images_per_buffer * ch
+        voltages = ct.SharedNDArray( # new shared memory is zeros
+            (frames * period_px, self.ao.num_channels), 'float32')
+        v = voltages.reshape(frames, period_px, self.ao.num_channels)
+        # Every frame (preframes too):
+        v[:, :rolling_px,
+          n2c['epi_camera_TTL']] = 5 # falling edge-> light on!
+        # Images are (image, channel) ordered, after the preframes:
+        for c, (channel, power) in enumerate(zip(self.epi_channels_per_image,
+                                                 self.epi_power_per_channel)):
+            v[self.epi_camera_preframes + c::ch,
+              rolling_px:period_px - jitter_px,
+              n2c[channel + '_power']] = 4.5 * power / 100
         # Timing attributes:
         self.epi_buffer_time_s = self.ao.p2s(voltages.shape[0])
         self.epi_frames_per_s = (
             self.epi_images_per_buffer / self.epi_buffer_time_s)
         return voltages
 
-    def _epi_prepare_to_save(
-        self, filename, folder_name, description, display):
+    def _epi_make_folders(self, folder_name):
         def make_folders(folder_name):
-            os.makedirs(folder_name)
-            os.makedirs(folder_name + '\\epi_data')
-            os.makedirs(folder_name + '\\epi_metadata')
-        assert type(filename) is str
+            os.makedirs(folder_name, exist_ok=True) # acquires may race here
+            os.makedirs(folder_name + '\\epi_data', exist_ok=True)
+            os.makedirs(folder_name + '\\epi_metadata', exist_ok=True)
         if folder_name is None:
             folder_index = 0
             dt = datetime.strftime(datetime.now(),'%Y-%m-%d_%H-%M-%S')
@@ -262,6 +494,12 @@ class Microscope:
             make_folders(folder_name)
         else:
             if not os.path.exists(folder_name): make_folders(folder_name)
+        return folder_name
+
+    def _epi_prepare_to_save(
+        self, filename, folder_name, description, display, metadata):
+        assert type(filename) is str
+        folder_name = self._epi_make_folders(folder_name) # if not done yet
         data_path =     folder_name + '\\epi_data\\'     + filename
         metadata_path = folder_name + '\\epi_metadata\\' + filename
         # save metadata:
@@ -288,27 +526,49 @@ class Microscope:
             'epi_camera_preframes':self.epi_camera_preframes,
             'epi_max_bytes_per_buffer':self.epi_max_bytes_per_buffer,
             'epi_max_data_buffers':self.epi_max_data_buffers,
+            'epi_binning':self.epi_binning,
+            'epi_averaging':self.epi_averaging,
+            'epi_correction':self.epi_correction,
             # -> calculated
             'epi_buffer_time_s':self.epi_buffer_time_s,
             'epi_frames_per_s':self.epi_frames_per_s,
             }
+        if metadata is not None: # extra items from 'acquire'
+            to_save.update(metadata)
         with open(os.path.splitext(metadata_path)[0] + '.txt', 'w') as file:
             for k, v in to_save.items():
                 file.write(k + ': ' + str(v) + '\n')
         return data_path
 
-    def _epi_get_data_buffer(self, shape, dtype):
-        while self.epi_num_active_data_buffers >= self.epi_max_data_buffers:
-            time.sleep(1e-3) # 1.7ms min
+    def _epi_reserve_data_buffer(self, ticket):
+        # Reserve in acquire order, so a queued acquisition can't take the
+        # last buffer from one that is ahead of it in the line for the ao:
+        with self._epi_data_buffers_changed:
+            self._epi_data_buffers_changed.wait_for(lambda: (
+                ticket == self._epi_next_data_buffer_ticket and
+                self.epi_num_active_data_buffers < self.epi_max_data_buffers))
+            self._epi_next_data_buffer_ticket += 1
+            self.epi_num_active_data_buffers += 1
+            self._epi_data_buffers_changed.notify_all()
+        return None
+
+    def _epi_unreserve_data_buffer(self):
+        with self._epi_data_buffers_changed:
+            self.epi_num_active_data_buffers -= 1
+            self._epi_data_buffers_changed.notify_all()
+        return None
+
+    def _epi_get_data_buffer(self, shape, dtype): # must be reserved first
         # Note: this does not actually allocate the memory. Allocation happens
         # during the first 'write' process inside camera.record_to_memory
         data_buffer = ct.SharedNDArray(shape, dtype)
-        self.epi_num_active_data_buffers += 1
+        with self._shared_arrays_lock: # see 'memory_report'
+            self._shared_arrays.add(data_buffer)
         return data_buffer
 
     def _epi_release_data_buffer(self, shared_numpy_array):
         assert isinstance(shared_numpy_array, ct.SharedNDArray)
-        self.epi_num_active_data_buffers -= 1
+        self._epi_unreserve_data_buffer()
 
     def epi_apply_settings( # Must call before .acquire()
         self,
@@ -320,11 +580,17 @@ class Microscope:
         epi_timestamp_mode=None,        # "off" or "binary" or "binary+ASCII"
         epi_images_per_buffer=None,     # Int
         epi_camera_preframes=None,      # Int
+        epi_binning=None,               # Int 1, 2 or 4 (height and width)
+        epi_averaging=None,             # Int, divides epi_images_per_buffer
+        epi_correction=None,            # "off" or "uint16" or "float32"
         ):
         args = locals()
         args.pop('self')
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        submit_s = time.perf_counter()
         def settings_task(custody):
             custody.switch_from(None, to=self.ao) # Can change settings
+            self._got_ao('interactive', submit_s)
             self._epi_settings_applied = False # In case the thread crashes
             # Attributes must be set previously or currently:
             for k, v in args.items():
@@ -340,47 +606,60 @@ class Microscope:
                 self.epi_height_px, self.epi_width_px, self.epi_roi_px = ( 
                     pco_panda42_bi.legalize_image_size(
                         h_px, w_px, verbose=False))
+            assert self.epi_binning in (1, 2, 4)
+            assert type(self.epi_averaging) is int
+            assert self.epi_images_per_buffer % self.epi_averaging == 0
+            assert self.epi_correction in ("off", "uint16", "float32")
             self._epi_check_memory()
             if self.epi_data_buffer_exceeded or self.epi_total_bytes_exceeded:
+                self._publish_settings()
                 custody.switch_from(self.ao, to=None)
                 return None
             # Send hardware commands, slowest to fastest:
-            if (epi_height_px is not None or
-                epi_width_px is not None or
-                epi_illumination_time_us is not None):
-                self.epi_camera._disarm()
-                self.epi_camera._set_roi(self.epi_roi_px) # height_px updated
-                self.epi_camera._set_exposure_time_us(int(
-                    self.epi_illumination_time_us +
-                    self.epi_camera.rolling_time_us))
-                self.epi_camera._arm(self.epi_camera._num_buffers)
-            if epi_timestamp_mode is not None:
-                self.epi_camera._set_timestamp_mode(epi_timestamp_mode)
-            if (epi_channels_per_image is not None or
-                epi_power_per_channel is not None or
-                epi_height_px is not None or
-                epi_illumination_time_us is not None or
-                epi_images_per_buffer is not None or
-                epi_camera_preframes is not None):
-                for channel in self.epi_channels_per_image:
-                    assert channel in self.illumination_sources
-                assert len(self.epi_power_per_channel) == (
-                    len(self.epi_channels_per_image))
-                for i, p in enumerate(self.epi_power_per_channel):
-                    assert 0 <= p <= 100
-                assert type(self.epi_images_per_buffer) is int
-                assert self.epi_images_per_buffer > 0
-                assert type(self.epi_camera_preframes) is int
+            # (only commands that change the last applied state are sent)
+            self._apply_camera_settings(
+                self.epi_camera,
+                self._epi_camera_state,
+                'epi_camera',
+                self.epi_roi_px,
+                self.epi_illumination_time_us,
+                self.epi_timestamp_mode)
+            if self.epi_raw_bytes == 0 and self._epi_camera_state.get('raw'):
+                self.epi_camera.free_raw_buffer() # no longer counted
+            self._epi_camera_state['raw'] = self.epi_raw_bytes > 0
+            for channel in self.epi_channels_per_image:
+                assert channel in self.illumination_sources
+            assert len(self.epi_power_per_channel) == (
+                len(self.epi_channels_per_image))
+            for i, p in enumerate(self.epi_power_per_channel):
+                assert 0 <= p <= 100
+            assert type(self.epi_images_per_buffer) is int
+            assert self.epi_images_per_buffer > 0
+            assert type(self.epi_camera_preframes) is int
+            voltages_state = (
+                tuple(self.epi_channels_per_image),
+                tuple(self.epi_power_per_channel),
+                self._epi_camera_state['exposure_us'],
+                self._epi_camera_state['rolling_time_us'],
+                self.epi_images_per_buffer,
+                self.epi_camera_preframes,
+                self.epi_jitter_us)
+            if voltages_state != self._epi_voltages_state:
                 self.epi_camera.num_images = ( # update attribute
                     self.epi_images + self.epi_camera_preframes)
                 self.epi_voltages = self._epi_calculate_voltages()
                 self._epi_update_voltages = True
+                self._epi_voltages_state = voltages_state
+            else:
+                self.skipped_commands['ao'] += 1
             # Finalize hardware commands, fastest to slowest:
             self._epi_settings_applied = True
+            self._publish_settings()
             custody.switch_from(self.ao, to=None) # Release camera
+        self._interactive_submitted() # settings always go first
         settings_thread = ct.CustodyThread(
             target=settings_task, first_resource=self.epi_camera).start()
-        self.unfinished_tasks.put(settings_thread)
+        self.unfinished_tasks.put(settings_thread, 'epi_apply_settings')
         return settings_thread
 
     def epi_acquire(
@@ -388,14 +667,30 @@ class Microscope:
         filename=None,      # None = no save, same string = overwrite
         folder_name=None,   # None = new folder, same string = re-use
         description=None,   # Optional metadata description
-        display=True):      # Optional turn off
+        display=True,       # Optional turn off
+        metadata=None,      # Optional dict of extra metadata
+        return_data=False,  # True = 'get_result()' returns the 'tcyx' data
+                            # (counted until you call 'release_data'),
+                            # False = the ao start time (perf_counter)
+        correct=True,       # False = skip 'epi_correction' (e.g. calibrate)
+        priority='interactive'): # or 'background' (see '_wait_gate')
+        assert priority in ('interactive', 'background')
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        submit_s = time.perf_counter()
         def acquire_task(custody):
+            # Prepare what doesn't need the ao while we wait in line for it:
+            if filename is not None:
+                make_folders_thread = ct.ResultThread(
+                    target=self._epi_make_folders, args=(folder_name,)).start()
+            self._epi_reserve_data_buffer(ticket)
             custody.switch_from(None, to=self.ao) # get ao
+            self._got_ao(priority, submit_s)
             if not self._epi_settings_applied:
                 if self.print_warnings:
                     print("\n%s: ***WARNING***: settings not applied"%self.name)
                     print("%s: -> please apply legal epi settings"%self.name)
                     print("%s: (all arguments must be specified at least once)")
+                self._epi_unreserve_data_buffer()
                 custody.switch_from(self.ao, to=None)
                 return
             if not self._epi_enabled:
@@ -408,22 +703,45 @@ class Microscope:
             if filename is not None:
                 prepare_to_save_thread = ct.ResultThread(
                     target=self._epi_prepare_to_save,
-                    args=(filename, folder_name, description, display)).start()
+                    args=(filename,
+                          make_folders_thread.get_result(),
+                          description,
+                          display,
+                          metadata)).start()
             # We have custody of the camera so attribute access is safe:
             im   = self.epi_images_per_buffer
             ch   = len(self.epi_channels_per_image)
             h_px = self.epi_height_px
             w_px = self.epi_width_px
             ti   = self.epi_images + self.epi_camera_preframes
+            bn   = self.epi_binning
+            av   = self.epi_averaging
+            reduced = (bn, av) != (1, 1)
+            if reduced: # preframes are dropped in the camera process
+                raw_shape = (ti, h_px, w_px)
+                im, h_px, w_px = im // av, h_px // bn, w_px // bn
+                ti = im * ch
             data_buffer = self._epi_get_data_buffer((ti, h_px, w_px), 'uint16')
             if self._epi_update_voltages:
                 write_voltages_thread.get_result()
                 self._epi_update_voltages = False
             # camera.record_to_memory() blocks, so we use a thread:
-            camera_thread = ct.ResultThread(
-                target=self.epi_camera.record_to_memory,
-                kwargs={'allocated_memory': data_buffer,
-                        'software_trigger': False},).start()
+            camera_start_s = time.perf_counter()
+            if reduced: # only the reduced data reaches shared memory
+                camera_thread = ct.ResultThread(
+                    target=self.epi_camera.record_to_memory_reduced,
+                    kwargs={'allocated_memory': data_buffer,
+                            'raw_shape': raw_shape,
+                            'preframes': self.epi_camera_preframes,
+                            'channels': ch,
+                            'binning': bn,
+                            'averaging': av,
+                            'software_trigger': False},).start()
+            else:
+                camera_thread = ct.ResultThread(
+                    target=self.epi_camera.record_to_memory,
+                    kwargs={'allocated_memory': data_buffer,
+                            'software_trigger': False},).start()
             # Race condition: the camera starts with (typically 16) single
             # frame buffers, which are filled by triggers from
             # ao.play_voltages(). The camera_thread empties them, hopefully
@@ -434,20 +752,67 @@ class Microscope:
             # On this machine the memory acquisition is faster than the camera
             # (~4GB/s vs ~1GB/s) but this could also be fragile if another
             # process interferes.
+            play_time_s = time.perf_counter()
             self.ao.play_voltages(block=False)
-            camera_thread.get_result()
+            if self._ao_idle_since_s is not None:
+                self.inter_acquire_dead_time_s = (
+                    play_time_s - self._ao_idle_since_s)
+            drain_end_s = camera_thread.get_result() # in the camera process
+            self._ao_idle_since_s = time.perf_counter()
+            # How close did we get to running out of camera buffers?
+            counters = None # pco image counter (not if binned/averaged)
+            if self.epi_timestamp_mode != "off" and not reduced:
+                counters = _decode_image_counters(data_buffer[:, 0, :4])
+            self._record_telemetry(
+                'epi',
+                raw_shape[0] if reduced else ti,
+                data_buffer.nbytes,
+                camera_start_s,
+                play_time_s,
+                drain_end_s,
+                counters)
             # Acquisition is 3D, but display and filesaving are 4D:
+            preframes = 0 if reduced else self.epi_camera_preframes
             data_buffer = data_buffer[ # ditch preframes
-                self.epi_camera_preframes:, :, :].reshape(im, ch, h_px, w_px)
+                preframes:, :, :].reshape(im, ch, h_px, w_px)
+            # Read the settings we still need while we have the ao, then let
+            # the next acquire have it while we correct, display and save
+            # (going straight to the display keeps it in acquire order):
+            correction = self.epi_correction if correct else "off"
+            if correction != "off":
+                terms = self._get_correction_terms('epi')
+            timestamp_mode = self.epi_timestamp_mode
+            rows = 0 if timestamp_mode == "off" else 8 // bn
             if display:
                 custody.switch_from(self.ao, to=self.display)
-                if self.epi_timestamp_mode == "binary+ASCII":
-                    self.display.show_epi_image(data_buffer[:,:,8:,:])
-                else:
-                    self.display.show_epi_image(data_buffer)
-                custody.switch_from(self.display, to=None)
             else:
                 custody.switch_from(self.ao, to=None)
+            if correction != "off":
+                data_buffer = self._correct(
+                    data_buffer, terms, correction, rows)
+            # Statistics on a subsample, while we process, display and save:
+            stats_thread = ct.ResultThread(
+                target=self._frame_stats,
+                args=('epi', data_buffer[:, :, rows:, :])).start()
+            # Process in worker processes while we display and save:
+            processing = len(self.processors['epi']) > 0
+            release = self._epi_release_data_buffer
+            if return_data: # the caller releases it, see 'release_data'
+                release = lambda data_buffer: None
+            if processing: # releases the data buffer when done
+                if filename is None: prepare_to_save_thread = None
+                self._process(
+                    self.processors['epi'],
+                    data_buffer,
+                    prepare_to_save_thread,
+                    release)
+            if display:
+                if timestamp_mode == "binary+ASCII":
+                    self.display.show_epi_image(
+                        _LazyStack(data_buffer[:,:,8 // bn:,:]))
+                else:
+                    self.display.show_epi_image(_LazyStack(data_buffer))
+                custody.switch_from(self.display, to=None)
             if filename is not None:
                 data_path = prepare_to_save_thread.get_result()
                 if self.verbose:
@@ -456,19 +821,335 @@ class Microscope:
                 imwrite(data_path, data_buffer[:,np.newaxis,:,:,:], imagej=True)
                 if self.verbose:
                     print("%s: done saving."%self.name)
-            self._epi_release_data_buffer(data_buffer)
+            stats = stats_thread.get_result()
+            if filename is not None:
+                self._save_frame_stats(
+                    data_path.replace('\\epi_data\\', '\\epi_metadata\\'),
+                    stats)
+            if not processing:
+                release(data_buffer)
+            self._cache_recent('epi', data_buffer, rows, filename, stats)
+            if return_data: # still counted against the data buffers
+                self._hold_data('epi', data_buffer)
+                return data_buffer
             del data_buffer
-        acquire_thread = ct.CustodyThread(
-            target=acquire_task, first_resource=self.ao).start()
-        self.unfinished_tasks.put(acquire_thread)
+            return play_time_s # when the ao started (see 'TimeLapse')
+        def start_acquire():
+            nonlocal ticket
+            with self._epi_data_buffers_changed: # ticket and ao line match
+                ticket = self._epi_data_buffer_tickets
+                self._epi_data_buffer_tickets += 1
+                acquire_thread = ct.CustodyThread(
+                    target=acquire_task, first_resource=self.ao).start()
+            return acquire_thread
+        ticket = None
+        if priority == 'interactive':
+            self._interactive_submitted()
+            acquire_thread = start_acquire()
+        else: # joins the ao line after the gate, so ticket order holds
+            acquire_thread = self._start_after_gate(start_acquire)
+        self.unfinished_tasks.put(acquire_thread, 'epi_acquire')
         return acquire_thread
 
+    def epi_acquire_series(
+        self,               # 'tcyx' format per time point
+        acquire_number,     # Int, time points
+        delay_s=0,          # Inter-acquire delay (s) >= epi_buffer_time_s
+        folder_name=None,   # None = new folder, same string = re-use
+        description=None,   # Optional metadata description
+        display=True):      # Optional turn off (shows the last time point)
+        # For short delays: all time points (and the idle time between them)
+        # are compiled into one waveform and recorded with a single
+        # 'record_to_memory' call, so they are spaced to the ao sample.
+        # Time points are saved as '000000.tif', '000001.tif'...
+        assert type(acquire_number) is int and acquire_number > 0
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        def series_task(custody):
+            save_folder_name = self._epi_make_folders(folder_name)
+            self._epi_reserve_data_buffer(ticket)
+            custody.switch_from(None, to=self.ao) # get ao
+            if not self._epi_settings_applied:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: settings not applied"%self.name)
+                    print("%s: -> please apply legal epi settings"%self.name)
+                self._epi_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if (self.epi_binning, self.epi_averaging) != (1, 1):
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> series needs epi_binning=1 and"%self.name,
+                          "epi_averaging=1")
+                self._epi_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if self.epi_correction != "off": # saved raw, so say so
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> series needs epi_correction='off'"%(
+                        self.name))
+                self._epi_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            # We have custody of the camera so attribute access is safe:
+            im   = self.epi_images_per_buffer
+            ch   = len(self.epi_channels_per_image)
+            h_px = self.epi_height_px
+            w_px = self.epi_width_px
+            ti   = self.epi_images + self.epi_camera_preframes
+            # Compile: each time point is padded with idle (0 V) samples:
+            buffer_px, num_channels = self.epi_voltages.shape
+            period_px = max(self.ao.s2p(delay_s), buffer_px)
+            total_px = (acquire_number - 1) * period_px + buffer_px
+            series_bytes = 2 * acquire_number * ti * h_px * w_px
+            voltage_bytes = (
+                total_px * num_channels * self.epi_voltages.itemsize)
+            other_bytes = ( # buffers already reserved (not our own slot)
+                self._reserved_bytes() - self.epi_bytes_per_data_buffer)
+            if (series_bytes + voltage_bytes + other_bytes >
+                self.max_allocated_bytes):
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> epi series exceeds max_allocated_bytes"%(
+                        self.name))
+                    print("%s: -> reduce acquire_number or delay_s"%self.name)
+                self._epi_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if not self._epi_enabled:
+                self._switch_microscopes(epi_enabled=True)
+            data_buffer, recorded = None, False
+            try: # on failure, restore the camera and free the slot
+                voltages = ct.SharedNDArray( # zeros, passed by name
+                    (acquire_number * period_px, num_channels),
+                    self.epi_voltages.dtype)
+                voltages.reshape(acquire_number, period_px, num_channels)[
+                    :, :buffer_px, :] = self.epi_voltages
+                voltages = voltages[:total_px, :] # no idle after the last
+                self._epi_update_voltages = True # series replaces them
+                write_voltages_thread = ct.ResultThread(
+                    target=self.ao._write_voltages, args=(voltages,)).start()
+                data_buffer = self._epi_get_data_buffer(
+                    (acquire_number * ti, h_px, w_px), 'uint16')
+                write_voltages_thread.get_result()
+                self.epi_camera.num_images = acquire_number * ti
+                camera_thread = ct.ResultThread(
+                    target=self.epi_camera.record_to_memory,
+                    kwargs={'allocated_memory': data_buffer,
+                            'software_trigger': False},).start()
+                self.ao.play_voltages(block=False)
+                camera_thread.get_result()
+                recorded = True
+            finally:
+                self.epi_camera.num_images = ti # restore for 'epi_acquire'
+                if not recorded:
+                    if data_buffer is None:
+                        self._epi_unreserve_data_buffer()
+                    else:
+                        self._epi_release_data_buffer(data_buffer)
+                    custody.switch_from(self.ao, to=None)
+            # Split back into 'tcyx' time points (ditch preframes):
+            series = data_buffer.reshape(acquire_number, ti, h_px, w_px)[
+                :, self.epi_camera_preframes:, :, :].reshape(
+                    acquire_number, im, ch, h_px, w_px)
+            period_s = self.ao.p2s(period_px)
+            if display:
+                custody.switch_from(self.ao, to=self.display)
+                if self.epi_timestamp_mode == "binary+ASCII":
+                    self.display.show_epi_image(
+                        _LazyStack(series[-1, :, :, 8:, :]))
+                else:
+                    self.display.show_epi_image(_LazyStack(series[-1]))
+                custody.switch_from(self.display, to=None)
+            else:
+                custody.switch_from(self.ao, to=None)
+            try:
+                for t in range(acquire_number):
+                    filename = '%06i.tif'%t
+                    data_path = self._epi_prepare_to_save(
+                        filename,
+                        save_folder_name,
+                        description,
+                        display,
+                        {'epi_series_delay_s':delay_s,
+                         'epi_series_period_s':period_s,
+                         'epi_series_time_point_s':t * period_s})
+                    if self.verbose:
+                        print("%s: saving '%s'"%(self.name, data_path))
+                    imwrite(data_path, series[t, :, np.newaxis, :, :, :],
+                            imagej=True)
+            finally: # also if a save failed
+                self._epi_release_data_buffer(data_buffer)
+            if self.verbose:
+                print("%s: done saving."%self.name)
+            del data_buffer, series
+        with self._epi_data_buffers_changed: # ticket and ao line must match
+            ticket = self._epi_data_buffer_tickets
+            self._epi_data_buffer_tickets += 1
+            series_thread = ct.CustodyThread(
+                target=series_task, first_resource=self.ao).start()
+        self.unfinished_tasks.put(series_thread, 'epi_acquire_series')
+        return series_thread
+
+    def epi_time_lapse(
+        self,
+        acquire_number,     # Int
+        delay_s=0,          # Inter-acquire delay (s) >= epi_buffer_time_s
+        folder_name=None,   # None = new folder, same string = re-use
+        description=None,   # Optional metadata description
+        display=True,       # Optional turn off
+        priority='interactive'): # 'background' lets snaps etc. go first
+        # Acquisitions are fired from a scheduler thread, so call after
+        # 'epi_apply_settings(...).get_result()' to get the right period:
+        period_s = max(delay_s, self.epi_buffer_time_s)
+        time_lapse = TimeLapse(
+            lambda **kwargs: self.epi_acquire(priority=priority, **kwargs),
+            acquire_number,
+            period_s,
+            folder_name,
+            description,
+            display,
+            name='%s epi time lapse'%self.name,
+            verbose=self.verbose,
+            path='epi',
+            make_folders=self._epi_make_folders)
+        self.unfinished_tasks.put(time_lapse, 'epi_time_lapse')
+        return time_lapse
+
+    def epi_calibrate(
+        self,
+        kind,               # "dark" (no light) or "flat" (uniform sample)
+        images=16):         # Int, averaged into one calibration frame
+        # Captures a calibration frame with the current epi settings (call
+        # when idle) and caches it in memory and in 'calibration_folder'.
+        # A "dark" frame is taken with the light off. 'epi_correction'
+        # then uses the frames that match the current ROI and exposure.
+        assert kind in ("dark", "flat")
+        assert type(images) is int and images > 0
+        def calibrate_task():
+            self._begin_exclusive('epi') # no other tasks in between
+            try:
+                powers = tuple(self.epi_power_per_channel)
+                images_per_buffer = self.epi_images_per_buffer
+                averaging = self.epi_averaging
+                settings = {'epi_images_per_buffer':images,
+                            'epi_averaging':1}
+                if kind == "dark":
+                    settings['epi_power_per_channel'] = (0,) * len(powers)
+                self.epi_apply_settings(**settings).get_result()
+                try:
+                    data = self.epi_acquire(
+                        display=False, return_data=True, correct=False
+                        ).get_result()
+                finally:
+                    self.epi_apply_settings( # restore
+                        epi_power_per_channel=powers,
+                        epi_images_per_buffer=images_per_buffer,
+                        epi_averaging=averaging).get_result()
+            finally:
+                self._end_exclusive()
+            if data is None: # settings not applied
+                return None
+            if kind == "dark": # same offset for every channel
+                frame = data.mean(axis=(0, 1), dtype='float32')
+            else:
+                frame = data.mean(axis=0, dtype='float32')
+            self.release_data(data)
+            del data
+            key = self._calibration_key('epi', kind)
+            self.calibrations[key] = frame
+            os.makedirs(self.calibration_folder, exist_ok=True)
+            imwrite(self._calibration_path(key), frame)
+            self._correction_terms['epi'] = None # rebuild with the new frame
+            if self.verbose:
+                print("%s: epi %s calibration saved"%(self.name, kind))
+            return frame
+        calibrate_thread = ct.ResultThread(target=calibrate_task).start()
+        self.unfinished_tasks.put(calibrate_thread, 'epi_calibrate')
+        return calibrate_thread
+
+    def epi_calibrate_jitter(
+        self,
+        images=100,         # Int, frames timed per measurement
+        margin=3,           # guard = margin * worst measured deviation
+        min_jitter_us=10):  # never less than this
+        # Measures how much the epi exposure starts (pco timestamps, 1us
+        # resolution) deviate from the ao frame period with the current
+        # settings (other tasks wait), and replaces the fixed 1ms guard per
+        # frame ('epi_jitter_us') with 'margin' times the worst deviation.
+        # A second run with the new guard must not miss any triggers, or
+        # the old guard is kept. The result is kept in 'calibration_folder'.
+        assert type(images) is int and images > 1
+        assert margin >= 1
+        def calibrate_task():
+            self._begin_exclusive('epi') # no other tasks in between
+            restore = {
+                'epi_images_per_buffer':self.epi_images_per_buffer,
+                'epi_binning':self.epi_binning,
+                'epi_averaging':self.epi_averaging,
+                'epi_timestamp_mode':self.epi_timestamp_mode}
+            old_jitter_us = self.epi_jitter_us
+            jitter_us = None # only set once the check has passed
+            try:
+                images_per_buffer = max(images // len(
+                    self.epi_channels_per_image), 2)
+                settings = {'epi_images_per_buffer':images_per_buffer,
+                            'epi_binning':1, # raw pixels have the timestamp
+                            'epi_averaging':1}
+                if self.epi_timestamp_mode == "off":
+                    settings['epi_timestamp_mode'] = "binary"
+                self.epi_apply_settings(**settings).get_result()
+                deviation_us, missing = self._measure_jitter_us('epi')
+                if deviation_us is not None and missing == 0:
+                    trial_us = max(
+                        int(np.ceil(margin * deviation_us)), min_jitter_us)
+                    self.epi_jitter_us = trial_us
+                    self.epi_apply_settings().get_result() # new voltages
+                    check_us, missing = self._measure_jitter_us('epi')
+                    if (check_us is not None and missing == 0 and
+                        check_us <= trial_us):
+                        jitter_us = trial_us
+            finally: # also if an acquire raised
+                if jitter_us is None: self.epi_jitter_us = old_jitter_us
+                try:
+                    self.epi_apply_settings(**restore).get_result()
+                finally:
+                    self._end_exclusive()
+            if jitter_us is None:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: epi jitter calibration"
+                          %self.name, "failed")
+                    print("%s: -> missed triggers or no timestamp"
+                          %self.name, "(keeping %ius)"%old_jitter_us)
+            else:
+                os.makedirs(self.calibration_folder, exist_ok=True)
+                with open(self._jitter_path('epi'), 'w') as file:
+                    file.write('%i\n'%jitter_us)
+                if self.verbose:
+                    print("%s: epi jitter %0.1fus -> guard %ius"%(
+                        self.name, deviation_us, jitter_us))
+            return jitter_us
+        calibrate_thread = ct.ResultThread(target=calibrate_task).start()
+        self.unfinished_tasks.put(calibrate_thread, 'epi_calibrate_jitter')
+        return calibrate_thread
+
     def _tbl_check_memory(self):
         # Data:
         self.tbl_images = self.tbl_images_per_buffer * len(
             self.tbl_channels_per_image)
-        self.tbl_bytes_per_data_buffer = (
-            2 * self.tbl_images * self.tbl_height_px * self.tbl_width_px)
+        bytes_per_px = 4 if self.tbl_correction == "float32" else 2
+        (self.tbl_bytes_per_data_buffer, # after binning and averaging
+         self.tbl_raw_bytes,             # the camera's, if reduced
+         self.tbl_bytes_per_slot,        # + uint16 source if float32
+         self.tbl_total_bytes) = (int(b) for b in _buffer_bytes(
+             self.tbl_height_px,
+             self.tbl_width_px,
+             self.tbl_images,
+             self.tbl_camera_preframes,
+             self.tbl_binning,
+             self.tbl_averaging,
+             bytes_per_px,
+             self.tbl_max_data_buffers))
         self.tbl_data_buffer_exceeded = False
         if self.tbl_bytes_per_data_buffer > self.tbl_max_bytes_per_buffer:
             self.tbl_data_buffer_exceeded = True
@@ -477,9 +1158,7 @@ class Microscope:
                 print("%s: -> tbl_data_buffer_exceeded"%self.name)
                 print("%s: -> reduce settings"%self.name +
                       " or increase 'tbl_max_bytes_per_buffer'")
-        # Total:
-        self.tbl_total_bytes = (
-            self.tbl_bytes_per_data_buffer * self.tbl_max_data_buffers)
+        # Total (with the camera's private raw buffer, if reduced):
         self.tbl_total_bytes_exceeded = False
         if self.tbl_total_bytes > self.max_allocated_bytes:
             self.tbl_total_bytes_exceeded = True
@@ -495,42 +1174,39 @@ class Microscope:
         # Timing information:
         exposure_px = self.ao.s2p(1e-6 * self.tbl_camera.exposure_us)
         rolling_px =  self.ao.s2p(1e-6 * self.tbl_camera.rolling_time_us)
-        jitter_px = max(self.ao.s2p(1000e-6), 1)
+        jitter_px = max(self.ao.s2p(1e-6 * self.tbl_jitter_us), 1)
         period_px = max(exposure_px, rolling_px) + jitter_px
-        # Calculate voltages:
-        voltages = []
-        # Add preframes (if any):
-        for frames in range(self.tbl_camera_preframes):
-            v = np.zeros((period_px, self.ao.num_channels), 'float64')
-            v[:rolling_px,
-              n2c['tbl_camera_TTL']] = 5 # falling edge-> light on!
-            voltages.append(v)
-        for images in range(self.tbl_images_per_buffer):
-            for channel, power in zip(self.tbl_channels_per_image,
-                                      self.tbl_power_per_channel):
-                v = np.zeros((period_px, self.ao.num_channels), 'float64')
-                v[:rolling_px,
-                  n2c['tbl_camera_TTL']] = 5 # falling edge-> light on!
-                if channel != '490_LED': # i.e. laser channels
-                    v[rolling_px:period_px - jitter_px,
-                      n2c[channel + '_TTL']] = 3
-                v[rolling_px:period_px - jitter_px,
-                  n2c[channel + '_power']] = 4.5 * power / 100
-                voltages.append(v)
-        voltages = np.concatenate(voltages, axis=0)
+        # Calculate voltages, in place in float32 shared memory (the ao
+        # process maps it by name, so nothing is pickled or copied):
+        ch = len(self.tbl_channels_per_image)
+        frames = self.tbl_camera_preframes + self.tbl_images_per_buffer * ch
+        voltages = ct.SharedNDArray( # new shared memory is zeros
+            (frames * period_px, self.ao.num_channels), 'float32')
+        v = voltages.reshape(frames, period_px, self.ao.num_channels)
+        # Every frame (preframes too):
+        v[:, :rolling_px,
+          n2c['tbl_camera_TTL']] = 5 # falling edge-> light on!
+        # Images are (image, channel) ordered, after the preframes:
+        for c, (channel, power) in enumerate(zip(self.tbl_channels_per_image,
+                                                 self.tbl_power_per_channel)):
+            if channel != '490_LED': # i.e. laser channels
+                v[self.tbl_camera_preframes + c::ch,
+                  rolling_px:period_px - jitter_px,
+                  n2c[channel + '_TTL']] = 3
+            v[self.tbl_camera_preframes + c::ch,
+              rolling_px:period_px - jitter_px,
+              n2c[channel + '_power']] = 4.5 * power / 100
         # Timing attributes:
         self.tbl_buffer_time_s = self.ao.p2s(voltages.shape[0])
         self.tbl_frames_per_s = (
             self.tbl_images_per_buffer / self.tbl_buffer_time_s)
         return voltages
 
-    def _tbl_prepare_to_save(
-        self, filename, folder_name, description, display):
+    def _tbl_make_folders(self, folder_name):
         def make_folders(folder_name):
-            os.makedirs(folder_name)
-            os.makedirs(folder_name + '\\tbl_data')
-            os.makedirs(folder_name + '\\tbl_metadata')
-        assert type(filename) is str
+            os.makedirs(folder_name, exist_ok=True) # acquires may race here
+            os.makedirs(folder_name + '\\tbl_data', exist_ok=True)
+            os.makedirs(folder_name + '\\tbl_metadata', exist_ok=True)
         if folder_name is None:
             folder_index = 0
             dt = datetime.strftime(datetime.now(),'%Y-%m-%d_%H-%M-%S')
@@ -541,6 +1217,12 @@ class Microscope:
             make_folders(folder_name)
         else:
             if not os.path.exists(folder_name): make_folders(folder_name)
+        return folder_name
+
+    def _tbl_prepare_to_save(
+        self, filename, folder_name, description, display, metadata):
+        assert type(filename) is str
+        folder_name = self._tbl_make_folders(folder_name) # if not done yet
         data_path =     folder_name + '\\tbl_data\\'     + filename
         metadata_path = folder_name + '\\tbl_metadata\\' + filename
         # save metadata:
@@ -567,27 +1249,49 @@ class Microscope:
             'tbl_camera_preframes':self.tbl_camera_preframes,
             'tbl_max_bytes_per_buffer':self.tbl_max_bytes_per_buffer,
             'tbl_max_data_buffers':self.tbl_max_data_buffers,
+            'tbl_binning':self.tbl_binning,
+            'tbl_averaging':self.tbl_averaging,
+            'tbl_correction':self.tbl_correction,
             # -> calculated
             'tbl_buffer_time_s':self.tbl_buffer_time_s,
             'tbl_frames_per_s':self.tbl_frames_per_s,
             }
+        if metadata is not None: # extra items from 'acquire'
+            to_save.update(metadata)
         with open(os.path.splitext(metadata_path)[0] + '.txt', 'w') as file:
             for k, v in to_save.items():
                 file.write(k + ': ' + str(v) + '\n')
         return data_path
 
-    def _tbl_get_data_buffer(self, shape, dtype):
-        while self.tbl_num_active_data_buffers >= self.tbl_max_data_buffers:
-            time.sleep(1e-3) # 1.7ms min
+    def _tbl_reserve_data_buffer(self, ticket):
+        # Reserve in acquire order, so a queued acquisition can't take the
+        # last buffer from one that is ahead of it in the line for the ao:
+        with self._tbl_data_buffers_changed:
+            self._tbl_data_buffers_changed.wait_for(lambda: (
+                ticket == self._tbl_next_data_buffer_ticket and
+                self.tbl_num_active_data_buffers < self.tbl_max_data_buffers))
+            self._tbl_next_data_buffer_ticket += 1
+            self.tbl_num_active_data_buffers += 1
+            self._tbl_data_buffers_changed.notify_all()
+        return None
+
+    def _tbl_unreserve_data_buffer(self):
+        with self._tbl_data_buffers_changed:
+            self.tbl_num_active_data_buffers -= 1
+            self._tbl_data_buffers_changed.notify_all()
+        return None
+
+    def _tbl_get_data_buffer(self, shape, dtype): # must be reserved first
         # Note: this does not actually allocate the memory. Allocation happens
         # during the first 'write' process inside camera.record_to_memory
         data_buffer = ct.SharedNDArray(shape, dtype)
-        self.tbl_num_active_data_buffers += 1
+        with self._shared_arrays_lock: # see 'memory_report'
+            self._shared_arrays.add(data_buffer)
         return data_buffer
 
     def _tbl_release_data_buffer(self, shared_numpy_array):
         assert isinstance(shared_numpy_array, ct.SharedNDArray)
-        self.tbl_num_active_data_buffers -= 1
+        self._tbl_unreserve_data_buffer()
 
     def tbl_apply_settings( # Must call before .acquire()
         self,
@@ -600,11 +1304,17 @@ class Microscope:
         tbl_timestamp_mode=None,        # "off" or "binary" or "binary+ASCII"
         tbl_images_per_buffer=None,     # Int
         tbl_camera_preframes=None,      # Int
+        tbl_binning=None,               # Int 1, 2 or 4 (height and width)
+        tbl_averaging=None,             # Int, divides tbl_images_per_buffer
+        tbl_correction=None,            # "off" or "uint16" or "float32"
         ):
         args = locals()
         args.pop('self')
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        submit_s = time.perf_counter()
         def settings_task(custody):
             custody.switch_from(None, to=self.ao) # Can change settings
+            self._got_ao('interactive', submit_s)
             self._tbl_settings_applied = False # In case the thread crashes
             # Attributes must be set previously or currently:
             for k, v in args.items():
@@ -620,52 +1330,65 @@ class Microscope:
                 self.tbl_height_px, self.tbl_width_px, self.tbl_roi_px = ( 
                     pco_panda42_bi.legalize_image_size(
                         h_px, w_px, verbose=False))
+            assert self.tbl_binning in (1, 2, 4)
+            assert type(self.tbl_averaging) is int
+            assert self.tbl_images_per_buffer % self.tbl_averaging == 0
+            assert self.tbl_correction in ("off", "uint16", "float32")
             self._tbl_check_memory()
             if self.tbl_data_buffer_exceeded or self.tbl_total_bytes_exceeded:
+                self._publish_settings()
                 custody.switch_from(self.ao, to=None)
                 return None
             # Send hardware commands, slowest to fastest:
 ##            if emission_filter is not None:
 ##                self.filter_wheel.move(
 ##                    tbl_emission_filter_options[emission_filter], block=False)
-            if (tbl_height_px is not None or
-                tbl_width_px is not None or
-                tbl_illumination_time_us is not None):
-                self.tbl_camera._disarm()
-                self.tbl_camera._set_roi(self.tbl_roi_px) # height_px updated
-                self.tbl_camera._set_exposure_time_us(int(
-                    self.tbl_illumination_time_us +
-                    self.tbl_camera.rolling_time_us))
-                self.tbl_camera._arm(self.tbl_camera._num_buffers)
-            if tbl_timestamp_mode is not None:
-                self.tbl_camera._set_timestamp_mode(tbl_timestamp_mode)
-            if (tbl_channels_per_image is not None or
-                tbl_power_per_channel is not None or
-                tbl_height_px is not None or
-                tbl_illumination_time_us is not None or
-                tbl_images_per_buffer is not None or
-                tbl_camera_preframes is not None):
-                for channel in self.tbl_channels_per_image:
-                    assert channel in self.illumination_sources
-                assert len(self.tbl_power_per_channel) == (
-                    len(self.tbl_channels_per_image))
-                for i, p in enumerate(self.tbl_power_per_channel):
-                    assert 0 <= p <= 100
-                assert type(self.tbl_images_per_buffer) is int
-                assert self.tbl_images_per_buffer > 0
-                assert type(self.tbl_camera_preframes) is int
+            # (only commands that change the last applied state are sent)
+            self._apply_camera_settings(
+                self.tbl_camera,
+                self._tbl_camera_state,
+                'tbl_camera',
+                self.tbl_roi_px,
+                self.tbl_illumination_time_us,
+                self.tbl_timestamp_mode)
+            if self.tbl_raw_bytes == 0 and self._tbl_camera_state.get('raw'):
+                self.tbl_camera.free_raw_buffer() # no longer counted
+            self._tbl_camera_state['raw'] = self.tbl_raw_bytes > 0
+            for channel in self.tbl_channels_per_image:
+                assert channel in self.illumination_sources
+            assert len(self.tbl_power_per_channel) == (
+                len(self.tbl_channels_per_image))
+            for i, p in enumerate(self.tbl_power_per_channel):
+                assert 0 <= p <= 100
+            assert type(self.tbl_images_per_buffer) is int
+            assert self.tbl_images_per_buffer > 0
+            assert type(self.tbl_camera_preframes) is int
+            voltages_state = (
+                tuple(self.tbl_channels_per_image),
+                tuple(self.tbl_power_per_channel),
+                self._tbl_camera_state['exposure_us'],
+                self._tbl_camera_state['rolling_time_us'],
+                self.tbl_images_per_buffer,
+                self.tbl_camera_preframes,
+                self.tbl_jitter_us)
+            if voltages_state != self._tbl_voltages_state:
                 self.tbl_camera.num_images = ( # update attribute
                     self.tbl_images + self.tbl_camera_preframes)
                 self.tbl_voltages = self._tbl_calculate_voltages()
                 self._tbl_update_voltages = True
+                self._tbl_voltages_state = voltages_state
+            else:
+                self.skipped_commands['ao'] += 1
             # Finalize hardware commands, fastest to slowest:
 ##            if emission_filter is not None:
 ##                self.filter_wheel._finish_moving()
             self._tbl_settings_applied = True
+            self._publish_settings()
             custody.switch_from(self.ao, to=None) # Release camera
+        self._interactive_submitted() # settings always go first
         settings_thread = ct.CustodyThread(
             target=settings_task, first_resource=self.tbl_camera).start()
-        self.unfinished_tasks.put(settings_thread)
+        self.unfinished_tasks.put(settings_thread, 'tbl_apply_settings')
         return settings_thread
 
     def tbl_acquire(
@@ -673,14 +1396,30 @@ class Microscope:
         filename=None,      # None = no save, same string = overwrite
         folder_name=None,   # None = new folder, same string = re-use
         description=None,   # Optional metadata description
-        display=True):      # Optional turn off
+        display=True,       # Optional turn off
+        metadata=None,      # Optional dict of extra metadata
+        return_data=False,  # True = 'get_result()' returns the 'tcyx' data
+                            # (counted until you call 'release_data'),
+                            # False = the ao start time (perf_counter)
+        correct=True,       # False = skip 'tbl_correction' (e.g. calibrate)
+        priority='interactive'): # or 'background' (see '_wait_gate')
+        assert priority in ('interactive', 'background')
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        submit_s = time.perf_counter()
         def acquire_task(custody):
+            # Prepare what doesn't need the ao while we wait in line for it:
+            if filename is not None:
+                make_folders_thread = ct.ResultThread(
+                    target=self._tbl_make_folders, args=(folder_name,)).start()
+            self._tbl_reserve_data_buffer(ticket)
             custody.switch_from(None, to=self.ao) # get ao
+            self._got_ao(priority, submit_s)
             if not self._tbl_settings_applied:
                 if self.print_warnings:
                     print("\n%s: ***WARNING***: settings not applied"%self.name)
                     print("%s: -> please apply legal tbl settings"%self.name)
                     print("%s: (all arguments must be specified at least once)")
+                self._tbl_unreserve_data_buffer()
                 custody.switch_from(self.ao, to=None)
                 return
             if self._epi_enabled:
@@ -693,22 +1432,45 @@ class Microscope:
             if filename is not None:
                 prepare_to_save_thread = ct.ResultThread(
                     target=self._tbl_prepare_to_save,
-                    args=(filename, folder_name, description, display)).start()
+                    args=(filename,
+                          make_folders_thread.get_result(),
+                          description,
+                          display,
+                          metadata)).start()
             # We have custody of the camera so attribute access is safe:
             im   = self.tbl_images_per_buffer
             ch   = len(self.tbl_channels_per_image)
             h_px = self.tbl_height_px
             w_px = self.tbl_width_px
             ti   = self.tbl_images + self.tbl_camera_preframes
+            bn   = self.tbl_binning
+            av   = self.tbl_averaging
+            reduced = (bn, av) != (1, 1)
+            if reduced: # preframes are dropped in the camera process
+                raw_shape = (ti, h_px, w_px)
+                im, h_px, w_px = im // av, h_px // bn, w_px // bn
+                ti = im * ch
             data_buffer = self._tbl_get_data_buffer((ti, h_px, w_px), 'uint16')
             if self._tbl_update_voltages:
                 write_voltages_thread.get_result()
                 self._tbl_update_voltages = False
             # camera.record_to_memory() blocks, so we use a thread:
-            camera_thread = ct.ResultThread(
-                target=self.tbl_camera.record_to_memory,
-                kwargs={'allocated_memory': data_buffer,
-                        'software_trigger': False},).start()
+            camera_start_s = time.perf_counter()
+            if reduced: # only the reduced data reaches shared memory
+                camera_thread = ct.ResultThread(
+                    target=self.tbl_camera.record_to_memory_reduced,
+                    kwargs={'allocated_memory': data_buffer,
+                            'raw_shape': raw_shape,
+                            'preframes': self.tbl_camera_preframes,
+                            'channels': ch,
+                            'binning': bn,
+                            'averaging': av,
+                            'software_trigger': False},).start()
+            else:
+                camera_thread = ct.ResultThread(
+                    target=self.tbl_camera.record_to_memory,
+                    kwargs={'allocated_memory': data_buffer,
+                            'software_trigger': False},).start()
             # Race condition: the camera starts with (typically 16) single
             # frame buffers, which are filled by triggers from
             # ao.play_voltages(). The camera_thread empties them, hopefully
@@ -719,20 +1481,67 @@ class Microscope:
             # On this machine the memory acquisition is faster than the camera
             # (~4GB/s vs ~1GB/s) but this could also be fragile if another
             # process interferes.
+            play_time_s = time.perf_counter()
             self.ao.play_voltages(block=False)
-            camera_thread.get_result()
+            if self._ao_idle_since_s is not None:
+                self.inter_acquire_dead_time_s = (
+                    play_time_s - self._ao_idle_since_s)
+            drain_end_s = camera_thread.get_result() # in the camera process
+            self._ao_idle_since_s = time.perf_counter()
+            # How close did we get to running out of camera buffers?
+            counters = None # pco image counter (not if binned/averaged)
+            if self.tbl_timestamp_mode != "off" and not reduced:
+                counters = _decode_image_counters(data_buffer[:, 0, :4])
+            self._record_telemetry(
+                'tbl',
+                raw_shape[0] if reduced else ti,
+                data_buffer.nbytes,
+                camera_start_s,
+                play_time_s,
+                drain_end_s,
+                counters)
             # Acquisition is 3D, but display and filesaving are 4D:
+            preframes = 0 if reduced else self.tbl_camera_preframes
             data_buffer = data_buffer[ # ditch preframes
-                self.tbl_camera_preframes:, :, :].reshape(im, ch, h_px, w_px)
+                preframes:, :, :].reshape(im, ch, h_px, w_px)
+            # Read the settings we still need while we have the ao, then let
+            # the next acquire have it while we correct, display and save
+            # (going straight to the display keeps it in acquire order):
+            correction = self.tbl_correction if correct else "off"
+            if correction != "off":
+                terms = self._get_correction_terms('tbl')
+            timestamp_mode = self.tbl_timestamp_mode
+            rows = 0 if timestamp_mode == "off" else 8 // bn
             if display:
                 custody.switch_from(self.ao, to=self.display)
-                if self.tbl_timestamp_mode == "binary+ASCII":
-                    self.display.show_tbl_image(data_buffer[:,:,8:,:])
-                else:
-                    self.display.show_tbl_image(data_buffer)
-                custody.switch_from(self.display, to=None)
             else:
                 custody.switch_from(self.ao, to=None)
+            if correction != "off":
+                data_buffer = self._correct(
+                    data_buffer, terms, correction, rows)
+            # Statistics on a subsample, while we process, display and save:
+            stats_thread = ct.ResultThread(
+                target=self._frame_stats,
+                args=('tbl', data_buffer[:, :, rows:, :])).start()
+            # Process in worker processes while we display and save:
+            processing = len(self.processors['tbl']) > 0
+            release = self._tbl_release_data_buffer
+            if return_data: # the caller releases it, see 'release_data'
+                release = lambda data_buffer: None
+            if processing: # releases the data buffer when done
+                if filename is None: prepare_to_save_thread = None
+                self._process(
+                    self.processors['tbl'],
+                    data_buffer,
+                    prepare_to_save_thread,
+                    release)
+            if display:
+                if timestamp_mode == "binary+ASCII":
+                    self.display.show_tbl_image(
+                        _LazyStack(data_buffer[:,:,8 // bn:,:]))
+                else:
+                    self.display.show_tbl_image(_LazyStack(data_buffer))
+                custody.switch_from(self.display, to=None)
             if filename is not None:
                 data_path = prepare_to_save_thread.get_result()
                 if self.verbose:
@@ -741,37 +1550,1804 @@ class Microscope:
                 imwrite(data_path, data_buffer[:,np.newaxis,:,:,:], imagej=True)
                 if self.verbose:
                     print("%s: done saving."%self.name)
-            self._tbl_release_data_buffer(data_buffer)
+            stats = stats_thread.get_result()
+            if filename is not None:
+                self._save_frame_stats(
+                    data_path.replace('\\tbl_data\\', '\\tbl_metadata\\'),
+                    stats)
+            if not processing:
+                release(data_buffer)
+            self._cache_recent('tbl', data_buffer, rows, filename, stats)
+            if return_data: # still counted against the data buffers
+                self._hold_data('tbl', data_buffer)
+                return data_buffer
             del data_buffer
-        acquire_thread = ct.CustodyThread(
-            target=acquire_task, first_resource=self.ao).start()
-        self.unfinished_tasks.put(acquire_thread)
+            return play_time_s # when the ao started (see 'TimeLapse')
+        def start_acquire():
+            nonlocal ticket
+            with self._tbl_data_buffers_changed: # ticket and ao line match
+                ticket = self._tbl_data_buffer_tickets
+                self._tbl_data_buffer_tickets += 1
+                acquire_thread = ct.CustodyThread(
+                    target=acquire_task, first_resource=self.ao).start()
+            return acquire_thread
+        ticket = None
+        if priority == 'interactive':
+            self._interactive_submitted()
+            acquire_thread = start_acquire()
+        else: # joins the ao line after the gate, so ticket order holds
+            acquire_thread = self._start_after_gate(start_acquire)
+        self.unfinished_tasks.put(acquire_thread, 'tbl_acquire')
         return acquire_thread
 
-    def finish_all_tasks(self):
-        collected_tasks = []
-        while True:
+    def tbl_acquire_series(
+        self,               # 'tcyx' format per time point
+        acquire_number,     # Int, time points
+        delay_s=0,          # Inter-acquire delay (s) >= tbl_buffer_time_s
+        folder_name=None,   # None = new folder, same string = re-use
+        description=None,   # Optional metadata description
+        display=True):      # Optional turn off (shows the last time point)
+        # For short delays: all time points (and the idle time between them)
+        # are compiled into one waveform and recorded with a single
+        # 'record_to_memory' call, so they are spaced to the ao sample.
+        # Time points are saved as '000000.tif', '000001.tif'...
+        assert type(acquire_number) is int and acquire_number > 0
+        self._wait_for_exclusive() # see '_begin_exclusive'
+        def series_task(custody):
+            save_folder_name = self._tbl_make_folders(folder_name)
+            self._tbl_reserve_data_buffer(ticket)
+            custody.switch_from(None, to=self.ao) # get ao
+            if not self._tbl_settings_applied:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: settings not applied"%self.name)
+                    print("%s: -> please apply legal tbl settings"%self.name)
+                self._tbl_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if (self.tbl_binning, self.tbl_averaging) != (1, 1):
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> series needs tbl_binning=1 and"%self.name,
+                          "tbl_averaging=1")
+                self._tbl_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if self.tbl_correction != "off": # saved raw, so say so
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> series needs tbl_correction='off'"%(
+                        self.name))
+                self._tbl_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            # We have custody of the camera so attribute access is safe:
+            im   = self.tbl_images_per_buffer
+            ch   = len(self.tbl_channels_per_image)
+            h_px = self.tbl_height_px
+            w_px = self.tbl_width_px
+            ti   = self.tbl_images + self.tbl_camera_preframes
+            # Compile: each time point is padded with idle (0 V) samples:
+            buffer_px, num_channels = self.tbl_voltages.shape
+            period_px = max(self.ao.s2p(delay_s), buffer_px)
+            total_px = (acquire_number - 1) * period_px + buffer_px
+            series_bytes = 2 * acquire_number * ti * h_px * w_px
+            voltage_bytes = (
+                total_px * num_channels * self.tbl_voltages.itemsize)
+            other_bytes = ( # buffers already reserved (not our own slot)
+                self._reserved_bytes() - self.tbl_bytes_per_data_buffer)
+            if (series_bytes + voltage_bytes + other_bytes >
+                self.max_allocated_bytes):
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: series rejected"%self.name)
+                    print("%s: -> tbl series exceeds max_allocated_bytes"%(
+                        self.name))
+                    print("%s: -> reduce acquire_number or delay_s"%self.name)
+                self._tbl_unreserve_data_buffer()
+                custody.switch_from(self.ao, to=None)
+                return
+            if self._epi_enabled:
+                self._switch_microscopes(epi_enabled=False)
+            data_buffer, recorded = None, False
+            try: # on failure, restore the camera and free the slot
+                voltages = ct.SharedNDArray( # zeros, passed by name
+                    (acquire_number * period_px, num_channels),
+                    self.tbl_voltages.dtype)
+                voltages.reshape(acquire_number, period_px, num_channels)[
+                    :, :buffer_px, :] = self.tbl_voltages
+                voltages = voltages[:total_px, :] # no idle after the last
+                self._tbl_update_voltages = True # series replaces them
+                write_voltages_thread = ct.ResultThread(
+                    target=self.ao._write_voltages, args=(voltages,)).start()
+                data_buffer = self._tbl_get_data_buffer(
+                    (acquire_number * ti, h_px, w_px), 'uint16')
+                write_voltages_thread.get_result()
+                self.tbl_camera.num_images = acquire_number * ti
+                camera_thread = ct.ResultThread(
+                    target=self.tbl_camera.record_to_memory,
+                    kwargs={'allocated_memory': data_buffer,
+                            'software_trigger': False},).start()
+                self.ao.play_voltages(block=False)
+                camera_thread.get_result()
+                recorded = True
+            finally:
+                self.tbl_camera.num_images = ti # restore for 'tbl_acquire'
+                if not recorded:
+                    if data_buffer is None:
+                        self._tbl_unreserve_data_buffer()
+                    else:
+                        self._tbl_release_data_buffer(data_buffer)
+                    custody.switch_from(self.ao, to=None)
+            # Split back into 'tcyx' time points (ditch preframes):
+            series = data_buffer.reshape(acquire_number, ti, h_px, w_px)[
+                :, self.tbl_camera_preframes:, :, :].reshape(
+                    acquire_number, im, ch, h_px, w_px)
+            period_s = self.ao.p2s(period_px)
+            if display:
+                custody.switch_from(self.ao, to=self.display)
+                if self.tbl_timestamp_mode == "binary+ASCII":
+                    self.display.show_tbl_image(
+                        _LazyStack(series[-1, :, :, 8:, :]))
+                else:
+                    self.display.show_tbl_image(_LazyStack(series[-1]))
+                custody.switch_from(self.display, to=None)
+            else:
+                custody.switch_from(self.ao, to=None)
             try:
-                th = self.unfinished_tasks.get_nowait()
-            except queue.Empty:
-                break
-            th.get_result()
-            collected_tasks.append(th)
-        return collected_tasks
+                for t in range(acquire_number):
+                    filename = '%06i.tif'%t
+                    data_path = self._tbl_prepare_to_save(
+                        filename,
+                        save_folder_name,
+                        description,
+                        display,
+                        {'tbl_series_delay_s':delay_s,
+                         'tbl_series_period_s':period_s,
+                         'tbl_series_time_point_s':t * period_s})
+                    if self.verbose:
+                        print("%s: saving '%s'"%(self.name, data_path))
+                    imwrite(data_path, series[t, :, np.newaxis, :, :, :],
+                            imagej=True)
+            finally: # also if a save failed
+                self._tbl_release_data_buffer(data_buffer)
+            if self.verbose:
+                print("%s: done saving."%self.name)
+            del data_buffer, series
+        with self._tbl_data_buffers_changed: # ticket and ao line must match
+            ticket = self._tbl_data_buffer_tickets
+            self._tbl_data_buffer_tickets += 1
+            series_thread = ct.CustodyThread(
+                target=series_task, first_resource=self.ao).start()
+        self.unfinished_tasks.put(series_thread, 'tbl_acquire_series')
+        return series_thread
+
+    def tbl_time_lapse(
+        self,
+        acquire_number,     # Int
+        delay_s=0,          # Inter-acquire delay (s) >= tbl_buffer_time_s
+        folder_name=None,   # None = new folder, same string = re-use
+        description=None,   # Optional metadata description
+        display=True,       # Optional turn off
+        priority='interactive'): # 'background' lets snaps etc. go first
+        # Acquisitions are fired from a scheduler thread, so call after
+        # 'tbl_apply_settings(...).get_result()' to get the right period:
+        period_s = max(delay_s, self.tbl_buffer_time_s)
+        time_lapse = TimeLapse(
+            lambda **kwargs: self.tbl_acquire(priority=priority, **kwargs),
+            acquire_number,
+            period_s,
+            folder_name,
+            description,
+            display,
+            name='%s tbl time lapse'%self.name,
+            verbose=self.verbose,
+            path='tbl',
+            make_folders=self._tbl_make_folders)
+        self.unfinished_tasks.put(time_lapse, 'tbl_time_lapse')
+        return time_lapse
+
+    def tbl_calibrate(
+        self,
+        kind,               # "dark" (no light) or "flat" (uniform sample)
+        images=16):         # Int, averaged into one calibration frame
+        # Captures a calibration frame with the current tbl settings (call
+        # when idle) and caches it in memory and in 'calibration_folder'.
+        # A "dark" frame is taken with the light off. 'tbl_correction'
+        # then uses the frames that match the current ROI and exposure.
+        assert kind in ("dark", "flat")
+        assert type(images) is int and images > 0
+        def calibrate_task():
+            self._begin_exclusive('tbl') # no other tasks in between
+            try:
+                powers = tuple(self.tbl_power_per_channel)
+                images_per_buffer = self.tbl_images_per_buffer
+                averaging = self.tbl_averaging
+                settings = {'tbl_images_per_buffer':images,
+                            'tbl_averaging':1}
+                if kind == "dark":
+                    settings['tbl_power_per_channel'] = (0,) * len(powers)
+                self.tbl_apply_settings(**settings).get_result()
+                try:
+                    data = self.tbl_acquire(
+                        display=False, return_data=True, correct=False
+                        ).get_result()
+                finally:
+                    self.tbl_apply_settings( # restore
+                        tbl_power_per_channel=powers,
+                        tbl_images_per_buffer=images_per_buffer,
+                        tbl_averaging=averaging).get_result()
+            finally:
+                self._end_exclusive()
+            if data is None: # settings not applied
+                return None
+            if kind == "dark": # same offset for every channel
+                frame = data.mean(axis=(0, 1), dtype='float32')
+            else:
+                frame = data.mean(axis=0, dtype='float32')
+            self.release_data(data)
+            del data
+            key = self._calibration_key('tbl', kind)
+            self.calibrations[key] = frame
+            os.makedirs(self.calibration_folder, exist_ok=True)
+            imwrite(self._calibration_path(key), frame)
+            self._correction_terms['tbl'] = None # rebuild with the new frame
+            if self.verbose:
+                print("%s: tbl %s calibration saved"%(self.name, kind))
+            return frame
+        calibrate_thread = ct.ResultThread(target=calibrate_task).start()
+        self.unfinished_tasks.put(calibrate_thread, 'tbl_calibrate')
+        return calibrate_thread
+
+    def tbl_calibrate_jitter(
+        self,
+        images=100,         # Int, frames timed per measurement
+        margin=3,           # guard = margin * worst measured deviation
+        min_jitter_us=10):  # never less than this
+        # Measures how much the tbl exposure starts (pco timestamps, 1us
+        # resolution) deviate from the ao frame period with the current
+        # settings (other tasks wait), and replaces the fixed 1ms guard per
+        # frame ('tbl_jitter_us') with 'margin' times the worst deviation.
+        # A second run with the new guard must not miss any triggers, or
+        # the old guard is kept. The result is kept in 'calibration_folder'.
+        assert type(images) is int and images > 1
+        assert margin >= 1
+        def calibrate_task():
+            self._begin_exclusive('tbl') # no other tasks in between
+            restore = {
+                'tbl_images_per_buffer':self.tbl_images_per_buffer,
+                'tbl_binning':self.tbl_binning,
+                'tbl_averaging':self.tbl_averaging,
+                'tbl_timestamp_mode':self.tbl_timestamp_mode}
+            old_jitter_us = self.tbl_jitter_us
+            jitter_us = None # only set once the check has passed
+            try:
+                images_per_buffer = max(images // len(
+                    self.tbl_channels_per_image), 2)
+                settings = {'tbl_images_per_buffer':images_per_buffer,
+                            'tbl_binning':1, # raw pixels have the timestamp
+                            'tbl_averaging':1}
+                if self.tbl_timestamp_mode == "off":
+                    settings['tbl_timestamp_mode'] = "binary"
+                self.tbl_apply_settings(**settings).get_result()
+                deviation_us, missing = self._measure_jitter_us('tbl')
+                if deviation_us is not None and missing == 0:
+                    trial_us = max(
+                        int(np.ceil(margin * deviation_us)), min_jitter_us)
+                    self.tbl_jitter_us = trial_us
+                    self.tbl_apply_settings().get_result() # new voltages
+                    check_us, missing = self._measure_jitter_us('tbl')
+                    if (check_us is not None and missing == 0 and
+                        check_us <= trial_us):
+                        jitter_us = trial_us
+            finally: # also if an acquire raised
+                if jitter_us is None: self.tbl_jitter_us = old_jitter_us
+                try:
+                    self.tbl_apply_settings(**restore).get_result()
+                finally:
+                    self._end_exclusive()
+            if jitter_us is None:
+                if self.print_warnings:
+                    print("\n%s: ***WARNING***: tbl jitter calibration"
+                          %self.name, "failed")
+                    print("%s: -> missed triggers or no timestamp"
+                          %self.name, "(keeping %ius)"%old_jitter_us)
+            else:
+                os.makedirs(self.calibration_folder, exist_ok=True)
+                with open(self._jitter_path('tbl'), 'w') as file:
+                    file.write('%i\n'%jitter_us)
+                if self.verbose:
+                    print("%s: tbl jitter %0.1fus -> guard %ius"%(
+                        self.name, deviation_us, jitter_us))
+            return jitter_us
+        calibrate_thread = ct.ResultThread(target=calibrate_task).start()
+        self.unfinished_tasks.put(calibrate_thread, 'tbl_calibrate_jitter')
+        return calibrate_thread
+
+    def _resolve_plan(self, plan):
+        # Each step only lists what changes, so work out the full settings
+        # of every step (in plan order) and check them all before starting:
+        setting_names = ('channels_per_image',
+                         'power_per_channel',
+                         'illumination_time_us',
+                         'height_px',
+                         'width_px',
+                         'timestamp_mode',
+                         'images_per_buffer',
+                         'camera_preframes',
+                         'binning',
+                         'averaging',
+                         'correction')
+        current = {}
+        for path in ('epi', 'tbl'):
+            current[path] = {path + '_' + n:getattr(self, path + '_' + n, None)
+                             for n in setting_names}
+        steps, problems = [], []
+        for i, step in enumerate(plan):
+            path = step['path']
+            assert path in ('epi', 'tbl'), "path must be 'epi' or 'tbl'"
+            for k, v in step.get('settings', {}).items():
+                assert k in current[path], "%s: unknown setting %s"%(
+                    self.name, k)
+                if v is not None:
+                    current[path][k] = v
+            settings = dict(current[path])
+            if None in settings.values():
+                problems.append((i, 'all settings must be set at least once'))
+                continue
+            h_px, w_px, roi_px = pco_panda42_bi.legalize_image_size(
+                settings[path + '_height_px'],
+                settings[path + '_width_px'],
+                verbose=False)
+            channels = settings[path + '_channels_per_image']
+            powers = settings[path + '_power_per_channel']
+            for channel in channels:
+                if channel not in self.illumination_sources:
+                    problems.append((i, 'unknown channel %s'%channel))
+            if len(powers) != len(channels):
+                problems.append((i, 'one power per channel'))
+            if len(channels) == 0:
+                problems.append((i, 'no channels'))
+                continue
+            bn = settings[path + '_binning']
+            av = settings[path + '_averaging']
+            images = settings[path + '_images_per_buffer'] * len(channels)
+            if bn not in (1, 2, 4) or images % (av * len(channels)) != 0:
+                problems.append((i, 'illegal binning or averaging'))
+                continue
+            bytes_per_px = 2
+            if settings[path + '_correction'] == "float32":
+                bytes_per_px = 4
+            # The same numbers '_*_check_memory' will reject them with:
+            bytes_per_data_buffer, _, _, total_bytes = _buffer_bytes(
+                h_px, w_px, images, settings[path + '_camera_preframes'],
+                bn, av, bytes_per_px,
+                getattr(self, path + '_max_data_buffers'))
+            if bytes_per_data_buffer > getattr(
+                self, path + '_max_bytes_per_buffer'):
+                problems.append((i, path + '_data_buffer_exceeded'))
+            if total_bytes > self.max_allocated_bytes:
+                problems.append((i, path + '_total_bytes_exceeded'))
+            camera_key = (roi_px, settings[path + '_illumination_time_us'])
+            steps.append({'index':i,
+                          'path':path,
+                          'settings':settings,
+                          'acquire':step.get('acquire', {}),
+                          'camera_key':camera_key})
+        return steps, problems
+
+    def _count_plan_changes(self, steps):
+        switches, rearms = 0, 0
+        epi_enabled = self._epi_enabled
+        camera_keys = {'epi':None, 'tbl':None}
+        for step in steps:
+            if (step['path'] == 'epi') != epi_enabled:
+                switches += 1
+                epi_enabled = not epi_enabled
+            if step['camera_key'] != camera_keys[step['path']]:
+                rearms += 1
+                camera_keys[step['path']] = step['camera_key']
+        return switches, rearms
+
+    def acquire_many(
+        self,
+        plan,           # List of dicts (see below)
+        reorder=False): # True = group steps to save switches/re-arms
+        # Each step is {'path':'epi' or 'tbl',
+        #               'settings':{... '*_apply_settings' kwargs ...},
+        #               'acquire':{... '*_acquire' kwargs ...}}
+        # and, like the apply_settings methods, settings only need to list
+        # what changes from the previous step on the same path.
+        steps, problems = self._resolve_plan(plan)
+        if len(problems) > 0: # reject the whole plan before starting
+            raise ValueError("%s: plan rejected: %s"%(self.name, problems))
+        switches, rearms = self._count_plan_changes(steps)
+        if reorder:
+            # Group by path (current path first) then by camera settings
+            # (in order of first use), so each path flip and camera re-arm
+            # happens once. (Waveforms depend on the camera's rolling time
+            # once its ROI is set, so they're compiled as each step's
+            # settings are applied, not up front.)
+            path_order = ('epi', 'tbl')
+            if not self._epi_enabled: path_order = ('tbl', 'epi')
+            first_use = {}
+            for step in steps:
+                first_use.setdefault(
+                    (step['path'], step['camera_key']), len(first_use))
+            steps.sort(key=lambda step: (
+                path_order.index(step['path']),
+                first_use[(step['path'], step['camera_key'])]))
+        new_switches, new_rearms = self._count_plan_changes(steps)
+        def plan_task():
+            t0 = time.perf_counter()
+            tasks = []
+            failed_step = None # settings not applied (plan stops there)
+            # Each acquire waits for its own settings (an acquire joins the
+            # ao line right away, settings only once they have the camera),
+            # but saving still overlaps the next step (see 'acquire_task'):
+            for step in steps:
+                path = step['path']
+                if path == 'epi':
+                    self.epi_apply_settings(**step['settings']).get_result()
+                    if not self._epi_settings_applied:
+                        failed_step = step['index']
+                        break
+                    tasks.append(self.epi_acquire(**step['acquire']))
+                else:
+                    self.tbl_apply_settings(**step['settings']).get_result()
+                    if not self._tbl_settings_applied:
+                        failed_step = step['index']
+                        break
+                    tasks.append(self.tbl_acquire(**step['acquire']))
+            results = [th.get_result() for th in tasks]
+            report = {
+                'steps':len(steps),
+                'completed_steps':len(tasks),
+                'failed':failed_step is not None,
+                'failed_step':failed_step, # index in 'plan', or None
+                'order':[step['index'] for step in steps],
+                'path_switches':new_switches,
+                'path_switches_saved':switches - new_switches,
+                'camera_rearms':new_rearms,
+                'camera_rearms_saved':rearms - new_rearms,
+                'estimated_time_saved_s':(
+                    (switches - new_switches) * self.switch_time_s +
+                    (rearms - new_rearms) * self.camera_rearm_time_s),
+                'time_s':time.perf_counter() - t0,
+                'results':results, # in execution order
+                }
+            if failed_step is not None and self.print_warnings:
+                print("\n%s: ***WARNING***: acquire_many stopped"%self.name)
+                print("%s: -> settings not applied for step %i"%(
+                    self.name, failed_step))
+            if self.verbose:
+                print("\n%s: acquire_many -> %i steps in %0.3fs"%(
+                    self.name, len(tasks), report['time_s']))
+                print("%s: -> saved %i path switches, %i camera re-arms"%(
+                    self.name, report['path_switches_saved'],
+                    report['camera_rearms_saved']),
+                      "(~%0.3fs)"%report['estimated_time_saved_s'])
+            return report
+        plan_thread = ct.ResultThread(target=plan_task).start()
+        self.unfinished_tasks.put(plan_thread, 'acquire_many')
+        return plan_thread
+
+    def add_processor(
+        self,
+        path,           # 'epi' or 'tbl'
+        function,       # function(data) -> array, must be picklable
+        name=None,      # Layer/file name, default = function name
+        display=False,  # Show the output in its own layer
+        save=False,     # Save the output next to the raw data
+        max_workers=None):
+        # 'function' runs in a worker process on the 'tcyx' data of every
+        # acquire, mapped from the shared data buffer (not copied). E.g.
+        # background subtraction, max projection or ratio images. The
+        # acquire thread doesn't wait; the data buffer is released when all
+        # processors are done.
+        assert path in ('epi', 'tbl')
+        if name is None: name = function.__name__
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers)
+        self.processors[path].append(
+            {'function':function, 'name':name, 'display':display, 'save':save})
+        self.processing_latency_s[name] = collections.deque(maxlen=100)
+        return None
+
+    def remove_processors(self, path):
+        self.processors[path] = []
+        return None
+
+    def _process(self, processors, data, prepare_to_save_thread, release):
+        t0 = time.perf_counter()
+        data_info = _shared_memory_info(data)
+        futures = [self._process_pool.submit(
+            _run_processor, p['function'], data_info) for p in processors]
+        def process_task(custody):
+            try:
+                for p, future in zip(processors, futures):
+                    output, worker_s = future.result()
+                    self.processing_latency_s[p['name']].append(
+                        (time.perf_counter() - t0, worker_s))
+                    if p['display']: # the acquires share the display
+                        custody.switch_from(None, to=self.display)
+                        self.display.show_processed_image(p['name'], output)
+                        custody.switch_from(self.display, to=None)
+                    if p['save'] and prepare_to_save_thread is not None:
+                        data_path = prepare_to_save_thread.get_result()
+                        imwrite(os.path.splitext(data_path)[0] +
+                                '_' + p['name'] + '.tif', output)
+            finally: # the workers are done with the shared memory
+                release(data)
+            return None
+        process_thread = ct.CustodyThread(target=process_task).start()
+        self.unfinished_tasks.put(process_thread, 'process')
+        return process_thread
+
+    def _frame_stats(self, path, data): # 'tcyx' data, no timestamp rows
+        t0 = time.perf_counter()
+        stats = _image_stats(
+            data, self.stats_stride, self.saturation_level, self.stats_bins)
+        stats['path'] = path
+        stats['time_s'] = t0
+        stats['compute_s'] = time.perf_counter() - t0
+        self.frame_stats[path].append(stats)
+        for callback in tuple(self._frame_stats_subscribers):
+            callback(stats)
+        return stats
+
+    def _save_frame_stats(self, metadata_path, stats): # append to metadata
+        with open(os.path.splitext(metadata_path)[0] + '.txt', 'a') as file:
+            file.write('frame_stats_stride: %i\n'%stats['stride'])
+            for k in ('mean', 'max', 'saturated'): # per image and channel
+                file.write('frame_%s: %s\n'%(k, stats[k].tolist()))
+            file.write('frame_histogram_bin_px: %s\n'%stats['bin_px'])
+            file.write('frame_histogram: %s\n'%( # per channel, all images
+                stats['histogram'].sum(axis=0).tolist()))
+        return None
+
+    def _calibration_key(self, path, kind):
+        key = (path,
+               kind,
+               repr(getattr(self, path + '_roi_px')),
+               getattr(self, '_' + path + '_camera_state')['exposure_us'],
+               getattr(self, path + '_binning'))
+        if kind == "flat": # gain depends on the light source
+            key += tuple(getattr(self, path + '_channels_per_image'))
+        return key
+
+    def _calibration_path(self, key):
+        name = '_'.join(str(k) for k in key)
+        name = ''.join(c for c in name if c.isalnum() or c in '_-.')
+        return os.path.join(self.calibration_folder, name + '.tif')
+
+    def _load_calibration(self, key): # memory first, then disk
+        if key not in self.calibrations:
+            path = self._calibration_path(key)
+            if not os.path.exists(path):
+                return None
+            self.calibrations[key] = imread(path).astype('float32')
+        return self.calibrations[key]
+
+    def _jitter_path(self, path):
+        return os.path.join(self.calibration_folder, path + '_jitter_us.txt')
+
+    def _load_jitter_us(self, path): # 1ms if never calibrated
+        jitter_path = self._jitter_path(path)
+        if not os.path.exists(jitter_path):
+            return 1000
+        try:
+            with open(jitter_path, 'r') as file:
+                return int(file.read())
+        except (OSError, ValueError): # don't block startup over it
+            if self.print_warnings:
+                print("\n%s: ***WARNING***: can't read '%s'"%(
+                    self.name, jitter_path))
+                print("%s: -> using 1000us, re-run '%s_calibrate_jitter'"%(
+                    self.name, path))
+            return 1000
+
+    def _measure_jitter_us(self, path): # (worst deviation, missing frames)
+        data = getattr(self, path + '_acquire')(
+            display=False, return_data=True, correct=False).get_result()
+        if data is None: # settings not applied
+            return None, 0
+        pixels = data.reshape(-1, *data.shape[-2:])[:, 0, :14].copy()
+        self.release_data(data)
+        del data
+        counters = _decode_image_counters(pixels[:, :4])
+        missing = int(np.count_nonzero(np.diff(counters) != 1))
+        images = getattr(self, path + '_images')
+        period_s = getattr(self, path + '_buffer_time_s') / (
+            images + getattr(self, path + '_camera_preframes'))
+        intervals_s = np.diff(_decode_image_times_s(pixels)) % 86400
+        deviation_us = 1e6 * np.abs(intervals_s - period_s).max()
+        return deviation_us, missing
+
+    def _get_correction_terms(self, path):
+        # Cached per path, and rebuilt when the ROI, exposure, binning or
+        # channels change (they are all part of the key):
+        key = self._calibration_key(path, "flat")[2:]
+        terms = self._correction_terms[path]
+        if terms is not None and terms[0] == key:
+            return terms[1:]
+        dark = self._load_calibration(self._calibration_key(path, "dark"))
+        flat = self._load_calibration(self._calibration_key(path, "flat"))
+        if dark is None and flat is None:
+            if self.print_warnings:
+                print("\n%s: ***WARNING***: no %s calibration"%(
+                    self.name, path))
+                print("%s: -> run '%s_calibrate' for this ROI"%(
+                    self.name, path), "and exposure")
+            terms = (None, None)
+        else:
+            if dark is None:
+                dark = np.zeros(flat.shape[-2:], 'float32')
+            gain = None
+            if flat is not None: # normalize each channel to its mean signal
+                signal = flat - dark
+                mean = signal.mean(axis=(1, 2), keepdims=True)
+                gain = np.divide(mean, signal,
+                                 out=np.ones_like(signal), where=signal > 0)
+            terms = (dark, gain)
+        self._correction_terms[path] = (key,) + terms
+        return terms
+
+    def _correct(self, data, terms, correction, rows):
+        # 'tcyx' data buffer, 'terms' from '_get_correction_terms' (read
+        # while the acquire still had the ao), 'rows' = timestamp rows:
+        dark, gain = terms
+        if dark is None:
+            return data
+        out = data # "uint16": corrected in place
+        if correction == "float32":
+            out = ct.SharedNDArray(data.shape, 'float32') # same buffer slot
+            with self._shared_arrays_lock:
+                self._shared_arrays.add(out)
+        if gain is not None: gain = gain[:, rows:, :] # leave the timestamp
+        _dark_flat_correct(data[:, :, rows:, :], dark[rows:, :], gain,
+                           out=out[:, :, rows:, :])
+        if out is not data:
+            out[:, :, :rows, :] = data[:, :, :rows, :]
+        return out
+
+    def _interactive_submitted(self):
+        with self._priority_changed:
+            self._interactive_waiting += 1
+        return None
+
+    def _got_ao(self, priority, submit_s): # call right after getting the ao
+        self.queue_wait_s[priority].append(time.perf_counter() - submit_s)
+        if priority == 'interactive':
+            with self._priority_changed:
+                self._interactive_waiting -= 1
+                self._priority_changed.notify_all()
+        return None
+
+    def _wait_gate(self):
+        # Background tasks wait here until no interactive task (settings,
+        # snaps...) is waiting for the ao, or for 'background_max_wait_s'
+        # at most so they can't starve:
+        with self._priority_changed:
+            self._priority_changed.wait_for(
+                lambda: self._interactive_waiting == 0,
+                self.background_max_wait_s)
+        return None
+
+    def _start_after_gate(self, start): # 'start()' returns the task thread
+        def background_task():
+            self._wait_gate()
+            return start().get_result()
+        return ct.ResultThread(target=background_task).start()
+
+    def queue_wait_stats(self): # per priority class
+        stats = {}
+        for priority, waits in self.queue_wait_s.items():
+            waits = np.array(waits)
+            if len(waits) == 0:
+                stats[priority] = {'tasks':0}
+                continue
+            stats[priority] = {'tasks':len(waits),
+                               'mean_wait_s':waits.mean(),
+                               'p95_wait_s':np.percentile(waits, 95),
+                               'max_wait_s':waits.max()}
+        return stats
+
+    def _cache_recent(self, path, data, rows, filename, stats):
+        # Keep the (released) data buffer itself, no copy, until evicted.
+        # The budget also fits in what the data buffers leave free, and
+        # in-flight or returned buffers (see 'release_data') can outlast
+        # a settings change, so count whichever is larger:
+        data_bytes = 0
+        for p in ('epi', 'tbl'):
+            data_bytes += max(
+                getattr(self, p + '_total_bytes', 0),
+                getattr(self, p + '_num_active_data_buffers', 0) *
+                getattr(self, p + '_bytes_per_slot', 0) +
+                getattr(self, p + '_raw_bytes', 0))
+        max_bytes = min(self.recent_max_bytes,
+                        self.max_allocated_bytes - data_bytes)
+        if self.recent_max_acquires == 0 or data.nbytes > max_bytes:
+            return None
+        snapshot = self.settings_snapshot
+        with self._recent_lock:
+            entry = {
+                'number':self._recent_number, # unique, see 'display_recent'
+                'path':path,
+                'time':datetime.strftime(datetime.now(),'%H:%M:%S'),
+                'time_s':time.perf_counter(),
+                'filename':filename,
+                'settings':None if snapshot is None else dict(snapshot),
+                'mean':float(stats['mean'].mean()),
+                'timestamp_rows':rows,
+                'data':data,
+                }
+            self._recent_number += 1
+            self.recent[path].append(entry)
+            self._evict_recent(max_bytes)
+        return None
+
+    def _recent_bytes(self):
+        return sum(e['data'].nbytes for p in ('epi', 'tbl')
+                   for e in self.recent[p])
+
+    def _evict_recent(self, max_bytes): # oldest first, call with the lock
+        for path in ('epi', 'tbl'):
+            while len(self.recent[path]) > self.recent_max_acquires:
+                self.recent[path].popleft()
+        while self._recent_bytes() > max_bytes:
+            oldest = min((self.recent[p][0]['time_s'], p)
+                         for p in ('epi', 'tbl') if len(self.recent[p]) > 0)
+            self.recent[oldest[1]].popleft()
+        return None
+
+    def recent_acquires(self, path): # oldest first, without the data
+        with self._recent_lock:
+            return [{k:v for k, v in e.items() if k != 'data'}
+                    for e in self.recent[path]]
+
+    def get_recent(self, path, number): # 'tcyx' data or None if evicted
+        with self._recent_lock:
+            for e in self.recent[path]:
+                if e['number'] == number:
+                    return e['data']
+        return None
+
+    def display_recent(self, path, number): # instant replay from RAM
+        data = self.get_recent(path, number)
+        if data is None:
+            if self.print_warnings:
+                print("\n%s: ***WARNING***: recent %s acquire"%(
+                    self.name, path), "%i was evicted"%number)
+            return None
+        rows = [e['timestamp_rows'] for e in self.recent_acquires(path)
+                if e['number'] == number]
+        rows = rows[0] if len(rows) > 0 else 0
+        def display_task(custody):
+            custody.switch_from(None, to=self.display)
+            getattr(self.display, 'show_%s_image'%path)(
+                _LazyStack(data[:, :, rows:, :]))
+            custody.switch_from(self.display, to=None)
+            return None
+        display_thread = ct.CustodyThread(
+            target=display_task, first_resource=None).start()
+        self.unfinished_tasks.put(display_thread, 'display_recent')
+        return display_thread
+
+    def display_saved(self, data_path, path='epi'):
+        # Show a saved 'tcyx' tif in the epi or tbl layer. The display
+        # memory maps the file, so only the slices you look at are read:
+        assert path in ('epi', 'tbl')
+        def display_task(custody):
+            custody.switch_from(None, to=self.display)
+            getattr(self.display, 'show_%s_image'%path)(
+                _LazyStack(file=data_path))
+            custody.switch_from(self.display, to=None)
+            return None
+        display_thread = ct.CustodyThread(
+            target=display_task, first_resource=None).start()
+        self.unfinished_tasks.put(display_thread, 'display_saved')
+        return display_thread
+
+    def _record_telemetry(
+        self,
+        path,
+        frames,             # recorded by the camera (with preframes)
+        data_bytes,         # written to shared memory
+        camera_start_s,     # 'record_to_memory' called
+        play_time_s,        # ao started (first trigger)
+        end_s,              # last frame drained (camera process clock)
+        counters):          # pco image counter per frame, or None
+        # The camera fills ~16 buffers and 'record_to_memory' drains them.
+        # If it keeps up, the last frame is drained right after it's taken;
+        # any lag means frames queued up in the camera buffers. 'end_s' is
+        # taken in the camera process (see '_CameraReduction'), so the
+        # return trip and any binning/averaging don't count as lag:
+        buffer_time_s = getattr(self, path + '_buffer_time_s')
+        frame_period_s = buffer_time_s / frames
+        lag_s = end_s - (play_time_s + buffer_time_s)
+        num_buffers = getattr(self, '_' + path + '_camera_state').get(
+            'num_buffers', 16)
+        queued = max(int(np.ceil(lag_s / frame_period_s)), 0)
+        missing, out_of_order = 0, 0
+        if counters is not None and len(counters) > 1:
+            steps = np.diff(counters)
+            missing = int(np.clip(steps - 1, 0, None).sum())
+            out_of_order = int(np.count_nonzero(steps < 1))
+        telemetry = {
+            'time_s':end_s,
+            'frames':frames,
+            'frame_period_s':frame_period_s,
+            'drain_lag_s':lag_s,
+            'drain_s_per_frame':(end_s - play_time_s) / frames,
+            'min_free_buffers':num_buffers - queued, # estimate, at the end
+            'write_bytes_per_s':data_bytes / (end_s - camera_start_s),
+            'missing_frames':missing,
+            'out_of_order_frames':out_of_order,
+            'overrun':missing > 0 or out_of_order > 0 or (
+                queued >= num_buffers),
+            }
+        self.camera_telemetry[path].append(telemetry)
+        if telemetry['overrun'] and self.print_warnings:
+            print("\n%s: ***WARNING***: %s camera overrun"%(self.name, path))
+            print("%s: -> %i missing, %i out of order, %0.3fs drain lag"%(
+                self.name, missing, out_of_order, lag_s))
+            print("%s: -> reduce the frame rate or image size"%self.name)
+        return telemetry
+
+    def measure_write_bandwidth(
+        self,
+        folder='.',             # the disk to test
+        test_bytes=512e6,       # large enough to get past the disk cache
+        block_bytes=16e6):
+        # Sustained write speed (bytes/s) with fsync, cached per folder:
+        folder = os.path.abspath(folder)
+        block = np.zeros(int(block_bytes), 'uint8')
+        test_path = os.path.join(folder, '_write_test.tmp')
+        t0 = time.perf_counter()
+        written = 0
+        with open(test_path, 'wb') as file:
+            while written < test_bytes:
+                file.write(block)
+                written += block.nbytes
+            file.flush()
+            os.fsync(file.fileno()) # on the disk, not just in the cache
+        bytes_per_s = written / (time.perf_counter() - t0)
+        os.remove(test_path)
+        self.write_bytes_per_s[folder] = bytes_per_s
+        if self.verbose:
+            print("%s: write bandwidth '%s' = %0.0f MB/s"%(
+                self.name, folder, 1e-6 * bytes_per_s))
+        return bytes_per_s
+
+    def plan_storage(
+        self,
+        path,               # 'epi' or 'tbl', uses the applied settings
+        acquire_number,     # Int
+        delay_s=0,          # Inter-acquire delay (s)
+        folder_name=None):  # where the run saves (None = current folder)
+        # Can the disk hold and keep up with a run? Returns a dict with
+        # 'verdict': "ok", "throttle" (the writes fall behind, use
+        # 'delay_s' from the plan) or "refuse" (not enough free space).
+        assert path in ('epi', 'tbl')
+        folder = os.path.abspath('.' if folder_name is None else folder_name)
+        while not os.path.exists(folder): # the run creates it later
+            folder = os.path.dirname(folder)
+        if folder not in self.write_bytes_per_s:
+            self.measure_write_bandwidth(folder)
+        bytes_per_s = self.write_bytes_per_s[folder]
+        free_bytes = shutil.disk_usage(folder).free
+        data_bytes = getattr(self, path + '_bytes_per_data_buffer')
+        buffer_time_s = getattr(self, path + '_buffer_time_s')
+        period_s = max(delay_s, buffer_time_s)
+        total_bytes = data_bytes * acquire_number
+        write_time_s = self.storage_margin * data_bytes / bytes_per_s
+        plan = {
+            'folder':folder,
+            'total_bytes':total_bytes,
+            'free_bytes':free_bytes,
+            'write_bytes_per_s':bytes_per_s,
+            'required_bytes_per_s':data_bytes / period_s,
+            'duration_s':period_s * (acquire_number - 1) + buffer_time_s,
+            'delay_s':delay_s,
+            'verdict':"ok",
+            'reason':None,
+            }
+        # Writes that are slower than the acquires pile up in the data
+        # buffers, which is fine until they run out:
+        backlog = acquire_number * (1 - period_s / write_time_s)
+        max_backlog = getattr(self, path + '_max_data_buffers') - 1
+        if self.storage_margin * total_bytes > free_bytes:
+            plan['verdict'] = "refuse"
+            plan['reason'] = "needs %0.2f GB, %0.2f GB free"%(
+                1e-9 * self.storage_margin * total_bytes, 1e-9 * free_bytes)
+        elif write_time_s > period_s and backlog > max_backlog:
+            plan['verdict'] = "throttle"
+            plan['delay_s'] = write_time_s
+            plan['reason'] = "disk writes %0.0f MB/s, run needs %0.0f MB/s"%(
+                1e-6 * bytes_per_s, 1e-6 * plan['required_bytes_per_s'])
+        if plan['verdict'] != "ok" and self.print_warnings:
+            print("\n%s: ***WARNING***: storage plan '%s'"%(
+                self.name, plan['verdict']))
+            print("%s: -> %s"%(self.name, plan['reason']))
+            if plan['verdict'] == "throttle":
+                print("%s: -> use delay_s >= %0.3f"%(self.name, write_time_s))
+        return plan
+
+    def plan_settings(self, path, **settings):
+        # Hardware-free preview of '*_apply_settings': the module function
+        # 'plan_settings' with the current path settings (and the measured
+        # rolling time per row) as defaults. Arrays broadcast, e.g.
+        # plan_settings('epi', height_px=np.arange(64, 2049, 64)).
+        assert path in ('epi', 'tbl')
+        def get(name): return getattr(self, path + '_' + name)
+        defaults = {
+            'height_px':get('height_px'),
+            'width_px':get('width_px'),
+            'illumination_time_us':get('illumination_time_us'),
+            'channels':len(get('channels_per_image')),
+            'images_per_buffer':get('images_per_buffer'),
+            'camera_preframes':get('camera_preframes'),
+            'binning':get('binning'),
+            'averaging':get('averaging'),
+            'bytes_per_px':4 if get('correction') == "float32" else 2,
+            'jitter_us':get('jitter_us'),
+            'rolling_us_per_row':self._rolling_us_per_row(path),
+            'ao_rate':self.ao_rate, # no round trip to the ao process
+            'max_data_buffers':get('max_data_buffers'),
+            }
+        for k in settings:
+            assert k in defaults or k in ('acquire_number', 'delay_s'), (
+                "%s: unknown setting '%s'"%(self.name, k))
+        defaults.update(settings)
+        return plan_settings(**defaults)
+
+    def _rolling_us_per_row(self, path): # measured if a ROI was applied
+        state = getattr(self, '_' + path + '_camera_state')
+        if 'rolling_time_us' not in state:
+            return default_rolling_us_per_row
+        return state['rolling_time_us'] / getattr(self, path + '_height_px')
+
+    def largest_height_px(
+        self,
+        path,                       # 'epi' or 'tbl'
+        frames_per_s=None,          # target (None = any)
+        max_bytes_per_buffer=None,  # (None = '*_max_bytes_per_buffer')
+        **settings):                # passed to 'plan_settings'
+        # The largest legal height (with the current or given settings)
+        # that reaches 'frames_per_s' and fits the memory limits, or None.
+        # Array settings broadcast and return an array (-1 = none):
+        if max_bytes_per_buffer is None:
+            max_bytes_per_buffer = getattr(
+                self, path + '_max_bytes_per_buffer')
+        width_px = settings.get('width_px')
+        if width_px is None or np.ndim(width_px) > 0: # e.g. a width grid
+            width_px = getattr(self, path + '_width_px')
+        key = (path, int(width_px))
+        if key not in self._legal_heights_px: # the rule doesn't change
+            self._legal_heights_px[key] = np.unique([
+                pco_panda42_bi.legalize_image_size(
+                    h, width_px, verbose=False)[0]
+                for h in range(2, 2049, 2)])
+        height_px = largest_setting(
+            lambda **s: self.plan_settings(path, **s),
+            'height_px',
+            self._legal_heights_px[key],
+            frames_per_s,
+            max_bytes_per_buffer,
+            self.max_allocated_bytes,
+            **settings)
+        if np.ndim(height_px) > 0:
+            return height_px
+        return None if height_px < 0 else int(height_px)
+
+    def _hold_data(self, path, data): # returned, so keep it counted
+        with self._held_data_lock:
+            self._held_data[data.shared_memory.name] = path
+        return None
+
+    def release_data(self, data):
+        # Call when done with the data from '*_acquire(return_data=True)',
+        # to free its data buffer slot (until then it counts against
+        # '*_max_data_buffers'). Also takes the shared memory name:
+        name = data if isinstance(data, str) else data.shared_memory.name
+        with self._held_data_lock:
+            path = self._held_data.pop(name, None)
+        if path is not None:
+            getattr(self, '_' + path + '_unreserve_data_buffer')()
+        return None
+
+    def _reserved_bytes(self): # data buffer slots in use, both paths
+        reserved = 0
+        for path in ('epi', 'tbl'):
+            reserved += (
+                getattr(self, path + '_num_active_data_buffers') *
+                getattr(self, path + '_bytes_per_slot', 0))
+        return reserved
+
+    def _begin_exclusive(self, path):
+        # For calibrations: new submissions from other threads wait (see
+        # '_wait_for_exclusive'), and everything already in line for the
+        # camera and the ao gets past them, so our own steps run back to
+        # back. Always pair with '_end_exclusive' (try/finally):
+        with self._exclusive_changed:
+            self._exclusive_changed.wait_for(
+                lambda: self._exclusive_owner is None)
+            self._exclusive_owner = threading.current_thread()
+        def barrier_task(custody): # same line as '*_apply_settings'
+            custody.switch_from(None, to=self.ao)
+            custody.switch_from(self.ao, to=None)
+            return None
+        ct.CustodyThread(
+            target=barrier_task,
+            first_resource=getattr(self, path + '_camera')).start(
+                ).get_result()
+        return None
+
+    def _end_exclusive(self):
+        with self._exclusive_changed:
+            self._exclusive_owner = None
+            self._exclusive_changed.notify_all()
+        return None
+
+    def _wait_for_exclusive(self): # call first when submitting a task
+        with self._exclusive_changed:
+            self._exclusive_changed.wait_for(lambda: self._exclusive_owner in (
+                None, threading.current_thread()))
+        return None
+
+    def _predict_memory(self):
+        # What the current settings should need (bytes), including what
+        # '_*_check_memory' leaves out: preframes, the camera's private raw
+        # buffer (binning/averaging), float32 copies, the display's copy
+        # of the last image and the voltages:
+        predicted = {'total':0}
+        for path in ('epi', 'tbl'):
+            if not getattr(self, '_' + path + '_settings_applied', False):
+                continue
+            def get(name): return getattr(self, path + '_' + name)
+            raw = 2 * (get('images') + get('camera_preframes')) * (
+                get('height_px') * get('width_px'))
+            data = get('bytes_per_data_buffer') # reduced
+            reduced = (get('binning'), get('averaging')) != (1, 1)
+            float32 = get('correction') == "float32"
+            buffer = data if float32 else (data if reduced else raw)
+            if float32: # the uint16 buffer is dropped once corrected
+                buffer += data // 2 if reduced else raw
+            items = {
+                'data_buffers':get('max_data_buffers') * buffer,
+                'camera_raw':raw if reduced else 0,
+                'display':data,
+                'voltages':getattr(self, path + '_voltages').nbytes,
+                }
+            items['total'] = sum(items.values())
+            predicted[path] = items
+            predicted['total'] += items['total']
+        with self._recent_lock: # released buffers kept for replay
+            predicted['recent'] = self._recent_bytes()
+        predicted['total'] += predicted['recent']
+        return predicted
+
+    def _child_processes(self): # name -> pid, needs psutil
+        pids = {'main':os.getpid()}
+        pids.update(self._child_pids)
+        # Anything else we started (display, processor workers...):
+        known = set(pids.values())
+        try:
+            children = psutil.Process().children()
+        except psutil.Error:
+            children = []
+        for child in children:
+            if child.pid not in known:
+                pids['child_%i'%child.pid] = child.pid
+        return pids
+
+    def memory_report(self):
+        # Measured memory compared with '_predict_memory'. Note: shared
+        # memory counts in the rss of every process that has touched it,
+        # so 'shared_bytes' (from the live data buffers) is the fair
+        # comparison for 'predicted_bytes'.
+        with self._shared_arrays_lock: # acquire threads add to it
+            shared = list(self._shared_arrays)
+        report = {
+            'predicted_bytes':self._predict_memory(),
+            'shared_bytes':sum(a.nbytes for a in shared),
+            'shared_arrays':len(shared),
+            }
+        del shared
+        if psutil is None:
+            if self.print_warnings and not self._warned_psutil:
+                print("\n%s: ***WARNING***: 'pip install psutil'"%self.name,
+                      "for measured memory")
+            self._warned_psutil = True # once is enough
+            return report
+        rss = {}
+        for name, pid in self._child_processes().items():
+            try:
+                rss[name] = psutil.Process(pid).memory_info().rss
+            except psutil.Error: # gone
+                pass
+        ram = psutil.virtual_memory()
+        report.update({
+            'rss_bytes':rss,
+            'total_rss_bytes':sum(rss.values()),
+            'available_bytes':ram.available,
+            'total_bytes':ram.total,
+            'swap_used_bytes':psutil.swap_memory().used,
+            })
+        if self._baseline_rss_bytes is not None: # growth since init
+            report['rss_growth_bytes'] = {
+                name:b - self._baseline_rss_bytes.get(name, 0)
+                for name, b in rss.items()}
+        report['over_prediction'] = (
+            report['shared_bytes'] > report['predicted_bytes']['total'])
+        report['low_memory'] = ram.available < self.memory_alert_bytes
+        self.last_memory_report = report
+        return report
+
+    def _monitor_memory(self): # warn once per episode
+        warned_low, warned_over = False, False
+        while not self._memory_monitor_stop.wait(
+            self.memory_monitor_period_s):
+            report = self.memory_report()
+            low, over = report['low_memory'], report['over_prediction']
+            if low: # give back half of the replay cache
+                with self._recent_lock:
+                    self._evict_recent(self._recent_bytes() // 2)
+            if low and not warned_low and self.print_warnings:
+                print("\n%s: ***WARNING***: low memory"%self.name)
+                print("%s: -> %0.2f GB available (alert at %0.2f GB)"%(
+                    self.name, 1e-9 * report['available_bytes'],
+                    1e-9 * self.memory_alert_bytes))
+                print("%s: -> reduce settings or 'max_data_buffers'"%(
+                    self.name), "before the machine starts swapping")
+            if over and not warned_over and self.print_warnings:
+                print("\n%s: ***WARNING***: shared memory above"%self.name,
+                      "prediction (%0.3f GB > %0.3f GB)"%(
+                          1e-9 * report['shared_bytes'],
+                          1e-9 * report['predicted_bytes']['total']))
+            warned_low, warned_over = low, over
+        return None
+
+    def finish_all_tasks(self): # raises the first error of what it waited on
+        return self.unfinished_tasks.finish_all()
+
+    def task_errors(self): # from tasks that finished earlier, then cleared
+        return self.unfinished_tasks.take_errors()
+
+    def task_stats(self): # counts and latencies per task name
+        return self.unfinished_tasks.stats()
 
     def close(self):
         if self.verbose: print("%s: closing..."%self.name)
         self.finish_all_tasks()
+        self._memory_monitor_stop.set()
+        self.unfinished_tasks.stop()
 ##        self.filter_wheel.close()
         self.epi_camera.close()
         self.tbl_camera.close()
 ##        self.laser_box.close()
         self.display.close()
         self.ao.close()
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
         if self.verbose: print("%s: done closing."%self.name)
 
+class _CameraReduction: # mixed into the camera class by '_open_camera'
+    def record_to_memory_reduced(
+        self,
+        allocated_memory,   # Shared, (images * channels, height, width)
+        raw_shape,          # (preframes + raw images * channels, h, w)
+        preframes,
+        channels,
+        binning,
+        averaging,
+        software_trigger=False):
+        # Runs in the camera process: record full frames into a private
+        # (re-used, counted in '*_total_bytes') buffer, then bin and
+        # average into shared memory, so only the reduced data crosses to
+        # other processes or gets saved. Returns when the drain ended:
+        raw = getattr(self, '_raw_buffer', None)
+        if raw is None or raw.shape != raw_shape:
+            raw = self._raw_buffer = np.zeros(raw_shape, 'uint16')
+        drain_end_s = self.record_to_memory(
+            allocated_memory=raw, software_trigger=software_trigger)
+        _bin_and_average(raw[preframes:], channels, binning, averaging,
+                         out=allocated_memory)
+        return drain_end_s
+
+    def record_to_memory(self, *args, **kwargs):
+        # Runs in the camera process: returns when the last frame was
+        # drained from the camera buffers ('time.perf_counter' is the same
+        # clock in every process), see 'Microscope._record_telemetry':
+        super().record_to_memory(*args, **kwargs)
+        return time.perf_counter()
+
+    def free_raw_buffer(self): # when the settings are no longer reduced
+        self._raw_buffer = None
+        return None
+
+    def get_pid(self): # see 'Microscope.memory_report'
+        return os.getpid()
+
+class _SharedFloat32Voltages: # mixed into the ao class by '_open_ao'
+    def _write_voltages(self, voltages):
+        # Waveforms arrive as float32 shared memory (mapped, not pickled);
+        # the card's driver wants float64, so convert here, in the ao
+        # process:
+        return super()._write_voltages(np.asarray(voltages, 'float64'))
+
+    def get_pid(self): # see 'Microscope.memory_report'
+        return os.getpid()
+
+def _open_ao(**kwargs): # runs in the ao process
+    class DAQ(_SharedFloat32Voltages, ni_PCI_6733.DAQ):
+        pass
+    return DAQ(**kwargs)
+
+def _open_camera(**kwargs): # runs in the camera process
+    class Camera(_CameraReduction, pco_panda42_bi.Camera):
+        pass
+    return Camera(**kwargs)
+
+def _bin_and_average(frames, channels, binning, averaging, out):
+    # frames are (images * channels, h, w) with the channel changing fastest
+    n, h, w = frames.shape
+    im, hb, wb = n // channels, h // binning, w // binning
+    frames = frames[:, :hb * binning, :wb * binning].reshape(
+        im // averaging, averaging, channels, hb, binning, wb, binning)
+    mean = frames.mean(axis=(1, 4, 6), dtype='float32') # no uint16 overflow
+    np.rint(mean, out=mean)
+    out[:] = mean.reshape(out.shape)
+    return out
+
+def _dark_flat_correct(data, dark, gain, out, scratch=None):
+    # out = (data - dark) * gain, one image at a time so the float32 scratch
+    # stays small. 'data' is (t, c, y, x), 'dark' (y, x), 'gain' (c, y, x)
+    # or None. Integer 'out' is rounded and clipped to its range.
+    integer = np.issubdtype(out.dtype, np.integer)
+    if integer:
+        limits = np.iinfo(out.dtype)
+        if scratch is None:
+            scratch = np.empty(data.shape[1:], 'float32')
+    for t in range(data.shape[0]):
+        s = scratch if integer else out[t]
+        np.subtract(data[t], dark, out=s, dtype='float32')
+        if gain is not None:
+            np.multiply(s, gain, out=s)
+        if integer:
+            np.clip(s, limits.min, limits.max, out=s)
+            np.rint(s, out=s)
+            out[t] = s
+    return out
+
+def benchmark_correction(
+    height_px=2048,     # full frame
+    width_px=2048,
+    images=10,
+    channels=1,
+    repeats=5):
+    # Seconds per image for each '*_correction' mode:
+    rng = np.random.default_rng(0)
+    data = rng.integers(
+        100, 4000, (images, channels, height_px, width_px), 'uint16')
+    dark = np.full((height_px, width_px), 100, 'float32')
+    gain = rng.uniform(0.9, 1.1, (channels, height_px, width_px)).astype(
+        'float32')
+    scratch = np.empty((channels, height_px, width_px), 'float32')
+    outputs = {"uint16":data.copy(), "float32":np.empty(data.shape, 'float32')}
+    results = {}
+    for mode, out in outputs.items():
+        times_s = []
+        for i in range(repeats):
+            out[:] = data # uint16 is corrected in place
+            t0 = time.perf_counter()
+            _dark_flat_correct(out if mode == "uint16" else data,
+                               dark, gain, out, scratch)
+            times_s.append(time.perf_counter() - t0)
+        results[mode] = min(times_s) / images
+        print('correction %s: %0.2fms per %ix%i image'%(
+            mode, 1e3 * results[mode], height_px, width_px))
+    return results
+
+default_rolling_us_per_row = 25e3 / 2048 # full frame ~25ms (~40 frames/s)
+
+def plan_settings(
+    height_px,                  # legal sizes, see 'legalize_image_size'
+    width_px,
+    illumination_time_us,
+    channels=1,                 # len(channels_per_image)
+    images_per_buffer=1,
+    camera_preframes=1,
+    binning=1,
+    averaging=1,
+    bytes_per_px=2,             # 4 for "float32" correction
+    jitter_us=1000,             # guard per frame, see '*_calibrate_jitter'
+    rolling_us_per_row=default_rolling_us_per_row,
+    ao_rate=1e5,
+    max_data_buffers=3,
+    acquire_number=1,           # for the run totals
+    delay_s=0):                 # inter-acquire delay (s)
+    # Works out what '*_apply_settings' would calculate (the timing of
+    # '_*_calculate_voltages' and the bytes of '_*_check_memory') without
+    # touching hardware. Every argument can be a scalar or an array, and
+    # arrays broadcast, so one call plans a whole grid of settings:
+    def s2p(seconds): # like 'ao.s2p'
+        return np.round(ao_rate * np.asarray(seconds))
+    rolling_us = rolling_us_per_row * np.asarray(height_px)
+    exposure_us = np.floor(illumination_time_us + rolling_us)
+    rolling_px = s2p(1e-6 * rolling_us)
+    period_px = np.maximum(s2p(1e-6 * exposure_us), rolling_px) + (
+        np.maximum(s2p(1e-6 * np.asarray(jitter_us)), 1))
+    images = np.asarray(images_per_buffer) * channels
+    buffer_time_s = (camera_preframes + images) * period_px / ao_rate
+    bytes_per_data_buffer, _, _, total_bytes = _buffer_bytes(
+        height_px, width_px, images, camera_preframes, binning, averaging,
+        bytes_per_px, max_data_buffers)
+    period_s = np.maximum(delay_s, buffer_time_s) # between acquires
+    return {
+        'rolling_time_us':rolling_us,
+        'exposure_us':exposure_us,
+        'frame_period_s':period_px / ao_rate,
+        'buffer_time_s':buffer_time_s,
+        'frames_per_s':images_per_buffer / buffer_time_s,
+        'bytes_per_data_buffer':bytes_per_data_buffer,
+        'total_bytes':total_bytes,
+        'run_bytes':bytes_per_data_buffer * acquire_number,
+        'run_time_s':period_s * (acquire_number - 1) + buffer_time_s,
+        'required_bytes_per_s':bytes_per_data_buffer / period_s,
+        }
+
+def _buffer_bytes(
+    height_px,
+    width_px,
+    images,                     # images_per_buffer * channels
+    camera_preframes,
+    binning,
+    averaging,
+    bytes_per_px,               # 4 for "float32" correction
+    max_data_buffers):
+    # The bytes that '_*_check_memory' accepts or rejects settings on, also
+    # used by 'plan_settings' and 'acquire_many' (arrays broadcast):
+    # (bytes_per_data_buffer, raw_bytes, bytes_per_slot, total_bytes)
+    height_px, width_px = np.asarray(height_px), np.asarray(width_px)
+    bytes_per_data_buffer = ( # after binning and averaging
+        bytes_per_px * (images // averaging) *
+        (height_px // binning) * (width_px // binning))
+    reduced = (np.asarray(binning) != 1) | (np.asarray(averaging) != 1)
+    raw_bytes = np.where( # the camera's private buffer (if reduced)
+        reduced, 2 * (camera_preframes + images) * height_px * width_px, 0)
+    bytes_per_slot = np.where( # float32 is corrected from a uint16 buffer
+        np.asarray(bytes_per_px) == 4,
+        bytes_per_data_buffer + bytes_per_data_buffer // 2,
+        bytes_per_data_buffer)
+    total_bytes = bytes_per_slot * max_data_buffers + raw_bytes
+    return bytes_per_data_buffer, raw_bytes, bytes_per_slot, total_bytes
+
+def largest_setting(
+    plan,                       # 'plan_settings' (or the same keywords)
+    name,                       # e.g. 'height_px'
+    candidates,                 # values to try for 'name'
+    frames_per_s=None,          # targets and limits (None = any)
+    max_bytes_per_buffer=None,
+    max_total_bytes=None,
+    **settings):                # the other settings (arrays broadcast)
+    # Inverse question: the largest candidate that reaches 'frames_per_s'
+    # within the byte limits, for every point of the settings grid (-1 if
+    # none). The candidates get their own (first) axis, so it's one call:
+    candidates = np.asarray(candidates)
+    ndim = max([np.ndim(v) for v in settings.values()] + [0])
+    settings[name] = candidates.reshape((-1,) + (1,) * ndim)
+    planned = plan(**settings)
+    shape = np.broadcast( # (candidates,) + the settings grid
+        settings[name], planned['frames_per_s'],
+        planned['bytes_per_data_buffer'], planned['total_bytes']).shape
+    ok = np.ones(shape, bool)
+    if frames_per_s is not None:
+        ok = ok & (planned['frames_per_s'] >= frames_per_s)
+    if max_bytes_per_buffer is not None:
+        ok = ok & (planned['bytes_per_data_buffer'] <= max_bytes_per_buffer)
+    if max_total_bytes is not None:
+        ok = ok & (planned['total_bytes'] <= max_total_bytes)
+    return np.where(ok, settings[name], -1).max(axis=0)
+
+def _decode_image_counters(pixels): # (frames, 4) from the first row
+    # pco binary timestamp: each pixel holds 2 BCD digits in its low byte,
+    # and pixels 0-3 are the image counter, most significant first:
+    bcd = pixels.astype('int64') & 0xFF
+    digits = 10 * (bcd >> 4) + (bcd & 0x0F)
+    return digits @ np.array([10**6, 10**4, 10**2, 1])
+
+def _decode_image_times_s(pixels): # (frames, 14) from the first row
+    # Same BCD format, pixels 8-13 are hours, minutes, seconds and 6 digits
+    # of microseconds (exposure start, camera clock), in seconds of the day:
+    bcd = pixels[:, 8:14].astype('int64') & 0xFF
+    digits = 10 * (bcd >> 4) + (bcd & 0x0F)
+    return digits @ np.array([3600, 60, 1, 1e-2, 1e-4, 1e-6])
+
+def _decimate_min_max(voltages, start_px, stop_px, max_points):
+    # Min and max of each channel over at most 'max_points' buckets,
+    # interleaved so one line per channel draws the full envelope:
+    start_px = min(max(start_px, 0), voltages.shape[0] - 1)
+    stop_px = min(max(stop_px, start_px + 1), voltages.shape[0])
+    bucket_px = max(int(np.ceil((stop_px - start_px) / max_points)), 1)
+    starts_px = np.arange(start_px, stop_px, bucket_px)
+    v = np.asarray(voltages[start_px:stop_px])
+    envelope = np.empty((2 * len(starts_px), voltages.shape[1]), v.dtype)
+    envelope[0::2] = np.minimum.reduceat(v, starts_px - start_px, axis=0)
+    envelope[1::2] = np.maximum.reduceat(v, starts_px - start_px, axis=0)
+    x_px = np.repeat(starts_px, 2)
+    x_px[1::2] = np.minimum(starts_px + bucket_px, stop_px) - 1
+    return x_px, envelope
+
+def plot_voltages(
+    voltages,                       # (samples, channels)
+    seconds_per_px,
+    names_to_voltage_channels=None, # for the legend
+    title=None,
+    max_points=2000,                # ~screen resolution
+    block=True):
+    # Waveform inspector: draws a min/max envelope of at most 'max_points'
+    # buckets per channel, and recomputes it for the visible range when
+    # you zoom or pan, so long waveforms plot fast without hiding pulses.
+    import matplotlib.pyplot as plt # only if we plot
+    c2n = {} # reverse lookup table; channel numbers to names
+    if names_to_voltage_channels is not None:
+        c2n = {v:k for k, v in names_to_voltage_channels.items()}
+    x_px, envelope = _decimate_min_max(
+        voltages, 0, voltages.shape[0], max_points)
+    used = [c for c in range(voltages.shape[1]) # skip channels at 0 V
+            if envelope[:, c].min() != 0 or envelope[:, c].max() != 0]
+    figure, axes = plt.subplots()
+    lines = {}
+    for c in used:
+        lines[c], = axes.plot(seconds_per_px * x_px, envelope[:, c],
+                              label=c2n.get(c, 'ao-%i'%c))
+    axes.set_xlim(0, seconds_per_px * voltages.shape[0])
+    axes.set_autoscalex_on(False) # refining must not move the view
+    def refine(axes): # 'xlim_changed' callback
+        start_s, stop_s = axes.get_xlim()
+        x_px, envelope = _decimate_min_max(
+            voltages,
+            int(start_s / seconds_per_px),
+            int(np.ceil(stop_s / seconds_per_px)) + 1,
+            max_points)
+        for c, line in lines.items():
+            line.set_data(seconds_per_px * x_px, envelope[:, c])
+        figure.canvas.draw_idle()
+        return None
+    axes.callbacks.connect('xlim_changed', refine)
+    axes.legend(loc='upper right')
+    axes.set_ylabel('Volts')
+    axes.set_xlabel('Seconds')
+    if title is not None: axes.set_title(title)
+    plt.show(block=block)
+    return figure
+
+def _image_stats(data, stride, saturation, bins):
+    # Per image and channel of 'tcyx' data, from every 'stride' pixel in y
+    # and x: mean, max, saturated pixels (scaled up to the full image) and
+    # a 'bins' histogram from 0 to 'saturation', all in a few numpy calls.
+    sub = data[:, :, ::stride, ::stride]
+    t, c = sub.shape[:2]
+    sub = sub.reshape(t, c, -1) # small copy
+    bin_px = (saturation + 1) / bins
+    index = (np.clip(sub, 0, saturation) / bin_px).astype('int64')
+    index += (bins * np.arange(t * c)).reshape(t, c, 1) # one range per frame
+    histogram = np.bincount(
+        index.ravel(), minlength=t * c * bins).reshape(t, c, bins)
+    return {'mean':sub.mean(axis=2, dtype='float64').round(2),
+            'max':sub.max(axis=2),
+            'saturated':stride**2 * np.count_nonzero(
+                sub >= saturation, axis=2),
+            'histogram':histogram,
+            'bin_px':bin_px,
+            'stride':stride}
+
+def _shared_memory_info(array): # 'ct.SharedNDArray' (or a view of one)
+    # Enough to map the same memory in another process (see below):
+    base_address = np.frombuffer(array.shared_memory.buf, 'uint8').ctypes.data
+    offset = array.ctypes.data - base_address
+    return (array.shared_memory.name,
+            array.shape,
+            array.dtype.str,
+            offset,
+            array.strides)
+
+def _map_shared_memory(name, shape, dtype, offset, strides):
+    memory = shared_memory.SharedMemory(name=name)
+    if sys.platform != 'win32': # the owner unlinks, not us
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    array = np.ndarray(shape, dtype, memory.buf, offset, strides)
+    return array, memory
+
+def _run_processor(function, data_info): # runs in a worker process
+    data, memory = _map_shared_memory(*data_info)
+    try:
+        t0 = time.perf_counter()
+        output = np.asarray(function(data))
+        worker_s = time.perf_counter() - t0
+        if np.shares_memory(output, data): # don't return a view of the buffer
+            output = output.copy()
+    finally: # also if 'function' raises
+        del data
+        memory.close()
+    return output, worker_s
+
+class TaskRegistry:
+    # Every task the Microscope starts is 'put' here. A reaper thread moves
+    # finished tasks into a bounded 'history' (name, latency, error), so
+    # only tasks in flight are kept alive (with their results). 'finish_all'
+    # raises errors from the tasks it waits for; errors from tasks that
+    # finished before that (their owner may have handled them already)
+    # are kept for 'take_errors' instead.
+    def __init__(self, max_history=1000, reap_period_s=0.05):
+        self.reap_period_s = reap_period_s
+        self.in_flight = {} # id -> (task, name, submitted_s)
+        self.history = collections.deque(maxlen=max_history)
+        self.counts = collections.Counter() # (name, 'submitted'/'done'...)
+        self.errors = collections.deque(maxlen=max_history) # (id, error)
+        self._lock = threading.Lock()
+        self._stop_requested = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, task, name=None): # any object with 'is_alive'/'get_result'
+        if name is None: name = type(task).__name__
+        with self._lock:
+            self.in_flight[id(task)] = (task, name, time.perf_counter())
+            self.counts[(name, 'submitted')] += 1
+        return None
+
+    def _run(self):
+        while not self._stop_requested.wait(self.reap_period_s):
+            self._reap()
+        return None
+
+    def _reap(self): # latency resolution is 'reap_period_s'
+        with self._lock: # all at once, so 'finish_all' sees whole results
+            finished = [(k, v) for k, v in self.in_flight.items()
+                        if not v[0].is_alive()]
+            for k, (task, name, submitted_s) in finished:
+                del self.in_flight[k]
+                error = None
+                try:
+                    task.get_result() # finished, so this doesn't block
+                except Exception as e:
+                    error = e
+                self.history.append({
+                    'name':name,
+                    'latency_s':time.perf_counter() - submitted_s,
+                    'error':None if error is None else repr(error)})
+                self.counts[(name, 'done' if error is None else 'error')] += 1
+                if error is not None:
+                    self.errors.append((k, error))
+        return None
+
+    def finish_all(self): # wait for everything in flight (and new tasks)
+        finished, errors = [], []
+        while True:
+            with self._lock:
+                tasks = [v[0] for v in self.in_flight.values()]
+            if len(tasks) == 0:
+                break
+            for task in tasks:
+                try:
+                    task.get_result()
+                except Exception as e: # raised below
+                    errors.append(e)
+            self._reap()
+            finished.extend(tasks)
+        waited = set(id(task) for task in finished)
+        with self._lock: # raised here, so not kept for 'take_errors'
+            kept = [(k, e) for k, e in self.errors if k not in waited]
+            self.errors.clear()
+            self.errors.extend(kept)
+        if len(errors) > 0:
+            raise errors[0]
+        return finished
+
+    def take_errors(self): # oldest first, see the class comment
+        with self._lock:
+            errors = [e for k, e in self.errors]
+            self.errors.clear()
+        return errors
+
+    def stats(self):
+        with self._lock:
+            history = list(self.history)
+            counts = dict(self.counts)
+            in_flight = collections.Counter(
+                v[1] for v in self.in_flight.values())
+        stats = {}
+        for (name, kind), n in counts.items():
+            stats.setdefault(name, {'in_flight':in_flight[name]})[kind] = n
+        for name in stats:
+            latencies_s = np.array(
+                [h['latency_s'] for h in history if h['name'] == name])
+            if len(latencies_s) > 0:
+                stats[name]['mean_latency_s'] = latencies_s.mean()
+                stats[name]['max_latency_s'] = latencies_s.max()
+        return stats
+
+    def stop(self):
+        self._stop_requested.set()
+        return None
+
+class TimeLapse:
+    def __init__(
+        self,
+        acquire,            # Microscope.epi_acquire or Microscope.tbl_acquire
+        acquire_number,     # Int
+        period_s,           # Time between acquire starts
+        folder_name,
+        description,
+        display,
+        name='time lapse',
+        verbose=True,
+        max_queued_acquires=2,  # fire late rather than pile up tasks
+        path='epi',             # where the acquires save their metadata
+        make_folders=None):     # Microscope._*_make_folders
+        self.acquire = acquire
+        self.acquire_number = acquire_number
+        self.period_s = period_s
+        self.folder_name = folder_name
+        self.description = description
+        self.display = display
+        self.name = name
+        self.verbose = verbose
+        self.max_queued_acquires = max_queued_acquires
+        self.path = path
+        self.make_folders = make_folders
+        self.start_times_s = [] # (planned, actual), from the first deadline
+        self._stop_requested = threading.Event()
+        self._thread = ct.ResultThread(target=self._run).start()
+
+    def _wait_until(self, deadline_s): # False if stopped first
+        while not self._stop_requested.is_set():
+            remaining_s = deadline_s - time.perf_counter()
+            if remaining_s <= 0:
+                return True
+            if remaining_s > 20e-3: # OS timers are only good to ~16 ms
+                self._stop_requested.wait(remaining_s - 20e-3)
+            else:
+                time.sleep(1e-3) # the ao queue adds more jitter than this
+        return False
+
+    def _run(self):
+        if self.verbose: print("\n%s: started"%self.name)
+        if self.make_folders is not None: # one folder for the whole run
+            self.folder_name = self.make_folders(self.folder_name)
+        tasks = collections.deque() # (index, planned start, acquire thread)
+        # Deadlines are absolute, so a late acquire doesn't delay the rest:
+        t0_s = time.perf_counter()
+        def finish_oldest(): # the acquire returns when the ao started
+            i, planned_s, task = tasks.popleft()
+            play_time_s = task.get_result()
+            if play_time_s is None: # settings not applied
+                return None
+            actual_s = play_time_s - t0_s
+            self.start_times_s.append((planned_s, actual_s)) # one tuple
+            if self.folder_name is not None: # saved by now, add to it
+                metadata_path = (self.folder_name + '\\' + self.path +
+                                 '_metadata\\' + '%06i.txt'%i)
+                if os.path.exists(metadata_path):
+                    with open(metadata_path, 'a') as file:
+                        file.write('time_lapse_actual_start_s: ' +
+                                   str(actual_s) + '\n')
+            return None
+        for i in range(self.acquire_number):
+            planned_s = i * self.period_s
+            if len(tasks) >= self.max_queued_acquires:
+                finish_oldest()
+            if not self._wait_until(t0_s + planned_s):
+                break
+            submit_s = time.perf_counter() - t0_s
+            tasks.append((i, planned_s, self.acquire(
+                filename='%06i.tif'%i,
+                folder_name=self.folder_name,
+                description=self.description,
+                display=self.display,
+                metadata={'time_lapse_planned_start_s':planned_s,
+                          'time_lapse_submit_s':submit_s})))
+        while len(tasks) > 0:
+            finish_oldest()
+        if self.folder_name is not None: # the run summary
+            with open(self.folder_name + '\\time_lapse.txt', 'w') as file:
+                file.write('period_s: %s\n'%self.period_s)
+                for k, v in self.jitter_stats().items():
+                    file.write(k + ': ' + str(v) + '\n')
+                file.write('planned_start_s, actual_start_s\n')
+                for p, a in self.start_times_s: # actual = the ao started
+                    file.write('%0.6f, %0.6f\n'%(p, a))
+        if self.verbose: print("%s: finished"%self.name)
+        return None
+
+    def jitter_stats(self): # actual (ao started) - planned start times
+        start_times_s = np.array(self.start_times_s).reshape(-1, 2)
+        lateness_s = start_times_s[:, 1] - start_times_s[:, 0]
+        if len(lateness_s) == 0:
+            return {'acquires':0}
+        return {'acquires':len(lateness_s),
+                'mean_jitter_s':lateness_s.mean(),
+                'std_jitter_s':lateness_s.std(),
+                'max_jitter_s':lateness_s.max()}
+
+    def stop(self): # no new acquires, queued ones still finish
+        self._stop_requested.set()
+        return None
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def get_result(self): # so 'finish_all_tasks' can wait on it
+        return self._thread.get_result()
+
+class _LazyStack:
+    # Array-like for napari, so the display only reads the slices it shows
+    # and the cost doesn't grow with the number of images. Backed by a
+    # shared data buffer (or a view of one) or a saved tif, and pickled
+    # as the shared memory name or file path, never the pixels.
+    def __init__(self, array=None, file=None):
+        assert (array is None) != (file is None)
+        if array is not None:
+            self._source = ('shared', _shared_memory_info(array))
+            self._array = array # already mapped in this process
+        else:
+            self._source = ('file', file)
+            self._array = None # opened on first use
+        self._memory = None
+        self._set_shape()
+
+    def _set_shape(self):
+        kind, info = self._source
+        if kind == 'shared':
+            name, self.shape, dtype, offset, strides = info
+            self.dtype = np.dtype(dtype)
+        else:
+            array = self._get_array()
+            self.shape, self.dtype = array.shape, array.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    def _get_array(self):
+        if self._array is None:
+            kind, info = self._source
+            if kind == 'shared':
+                self._array, self._memory = _map_shared_memory(*info)
+            else:
+                array = memmap(info, mode='r') # needs an uncompressed tif
+                if array.ndim == 5: # saved as imagej 'tzcyx', z = 1
+                    array = array[:, 0, :, :, :]
+                self._array = array
+        return self._array
+
+    def __getstate__(self): # the source, not the pixels
+        return {'_source':self._source}
+
+    def __setstate__(self, state):
+        self._source = state['_source']
+        self._array, self._memory = None, None
+        if self._source[0] == 'shared': # map now, the owner may let go
+            self._get_array()
+        self._set_shape()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key): # only this slice is read
+        return np.asarray(self._get_array()[key])
+
+    def __array__(self, dtype=None): # everything, avoid if possible
+        return np.asarray(self._get_array(), dtype)
+
+class _NoDisplay: # stands in for the display in a headless 'Microscope'
+    def __getattr__(self, name): # 'show_*_image', 'close'...
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
 class _CustomNapariDisplay:
     def __init__(self, auto_contrast=False):
+        import napari # only in the display subprocess
         self.auto_contrast = auto_contrast
         self.viewer = napari.Viewer()
 
@@ -782,25 +3358,43 @@ class _CustomNapariDisplay:
                 # set the slider position to the max legal value:
                 self.viewer.dims.set_point(ax, image.shape[ax] - 1)
 
-    def _reset_contrast(self, image): # 4D image min to max
+    def _current_slice_limits(self, image): # min to max of what we see
+        point = self.viewer.dims.current_step[-image.ndim:][:-2]
+        index = tuple(min(p, n - 1) for p, n in zip(point, image.shape))
+        image_slice = np.asarray(image[index])
+        low, high = float(image_slice.min()), float(image_slice.max())
+        return (low, max(high, low + 1))
+
+    def _reset_contrast(self, image): # current slice min to max
+        limits = self._current_slice_limits(image)
         for layer in self.viewer.layers: # image, grid, tile
-            layer.contrast_limits = (image.min(), image.max())
+            layer.contrast_limits = limits
 
     def show_epi_image(self, epi_image):
         self._legalize_slider(epi_image)
         if self.auto_contrast:
             self._reset_contrast(epi_image)
-        if not hasattr(self, 'epi_image'):
-            self.epi_image = self.viewer.add_image(epi_image)
+        if not hasattr(self, 'epi_image'): # limits given, napari won't scan
+            self.epi_image = self.viewer.add_image(
+                epi_image,
+                contrast_limits=self._current_slice_limits(epi_image))
         else:
             self.epi_image.data = epi_image
 
+    def show_processed_image(self, name, image):
+        if name not in self.viewer.layers:
+            self.viewer.add_image(image, name=name)
+        else:
+            self.viewer.layers[name].data = image
+
     def show_tbl_image(self, tbl_image):
         self._legalize_slider(tbl_image)
         if self.auto_contrast:
             self._reset_contrast(tbl_image)
-        if not hasattr(self, 'tbl_image'):
-            self.tbl_image = self.viewer.add_image(tbl_image)
+        if not hasattr(self, 'tbl_image'): # limits given, napari won't scan
+            self.tbl_image = self.viewer.add_image(
+                tbl_image,
+                contrast_limits=self._current_slice_limits(tbl_image))
         else:
             self.tbl_image.data = tbl_image
 
@@ -0,0 +1,173 @@
+# Imports from the python standard library:
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Our code, one .py file per module, copy files to your local directory:
+import tripsy_microscope as tbl
+
+# Methods that launch a task: they're called one at a time, in call order,
+# so acquires join the custody line in the order they were awaited:
+task_calls = (
+    'epi_apply_settings', 'tbl_apply_settings',
+    'epi_acquire', 'tbl_acquire',
+    'epi_acquire_series', 'tbl_acquire_series',
+    'epi_time_lapse', 'tbl_time_lapse',
+    'epi_calibrate', 'tbl_calibrate',
+    'epi_calibrate_jitter', 'tbl_calibrate_jitter',
+    'acquire_many',
+    'display_saved',
+    'display_recent',
+    )
+
+class AsyncMicroscope:
+    # Wraps a 'tbl.Microscope' (or a 'MicroscopeClient'): same methods, but
+    # they return an awaitable. Task launches ('task_calls') run on one
+    # submit thread, everything else (e.g. 'plan_storage') in the loop's
+    # executor, so the event loop never blocks. One watcher thread waits
+    # on all the pending tasks and hands each result to the loop
+    # ('call_soon_threadsafe'). Call from a coroutine.
+    def __init__(self, scope, progress_s=0.5, poll_s=5e-3):
+        self.scope = scope
+        self.progress_s = progress_s # time between 'progress' events
+        self.poll_s = poll_s # how often the watcher checks each task
+        self.event_callbacks = [] # callback(time_s, name, event, elapsed_s)
+        self._pending = [] # [task, future, name, loop, t0_s, progress_s]
+        self._pending_lock = threading.Lock()
+        self._watcher = None # thread, only while tasks are pending
+        self._submitter = ThreadPoolExecutor(max_workers=1) # keeps order
+
+    def __getattr__(self, name): # only called for non-local attributes
+        if name.startswith('__') or name in (
+            'scope', 'progress_s', 'poll_s', 'event_callbacks', '_pending',
+            '_pending_lock', '_watcher', '_submitter'):
+            raise AttributeError(name) # e.g. during __init__, don't recurse
+        attribute = getattr(self.scope, name)
+        if not callable(attribute):
+            return attribute
+        executor = self._submitter if name in task_calls else None
+        def method(*args, **kwargs): # queued now, so call order is kept
+            call = asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(attribute, *args, **kwargs))
+            return asyncio.ensure_future(self._result(call, name))
+        return method
+
+    async def _result(self, call, name):
+        result = await call
+        if hasattr(result, 'get_result') and hasattr(result, 'is_alive'):
+            return await self._add_task(result, name)
+        return result
+
+    def _emit(self, name, event, elapsed_s):
+        # 'submitted', 'progress' (every 'progress_s'), 'done' or 'error':
+        t_s = time.perf_counter()
+        for callback in tuple(self.event_callbacks):
+            callback(t_s, name, event, elapsed_s)
+        return None
+
+    def _add_task(self, task, name):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        t0_s = time.perf_counter()
+        self._emit(name, 'submitted', 0)
+        with self._pending_lock:
+            self._pending.append(
+                [task, future, name, loop, t0_s, t0_s + self.progress_s])
+            if self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch, daemon=True)
+                self._watcher.start()
+        return future
+
+    def _watch(self): # the watcher thread, exits when nothing is pending
+        while True:
+            with self._pending_lock:
+                if len(self._pending) == 0:
+                    self._watcher = None
+                    return None
+                pending = list(self._pending)
+            finished = [e for e in pending if not e[0].is_alive()]
+            for entry in finished:
+                task, future, name, loop, t0_s, _ = entry
+                try: # the task has finished so this doesn't block
+                    result, error = task.get_result(), None
+                except Exception as e:
+                    result, error = None, e
+                with self._pending_lock:
+                    self._pending.remove(entry)
+                loop.call_soon_threadsafe(
+                    self._finish, future, name, result, error,
+                    time.perf_counter() - t0_s)
+            now_s = time.perf_counter()
+            for entry in pending: # progress events on their own timer
+                if entry not in finished and now_s >= entry[5]:
+                    entry[5] += self.progress_s
+                    task, future, name, loop, t0_s, _ = entry
+                    loop.call_soon_threadsafe(
+                        self._emit, name, 'progress', now_s - t0_s)
+            if len(finished) > 0:
+                continue
+            # Wait a little, waking early if a local task finishes:
+            threads = [e[0] for e in pending
+                       if isinstance(e[0], threading.Thread)]
+            if len(threads) > 0:
+                threads[0].join(self.poll_s)
+            else: # e.g. a 'TimeLapse' or a task in the device server
+                time.sleep(self.poll_s)
+
+    def _finish(self, future, name, result, error, elapsed_s): # in the loop
+        if error is not None:
+            if not future.cancelled(): future.set_exception(error)
+            self._emit(name, 'error', elapsed_s)
+        else:
+            if not future.cancelled(): future.set_result(result)
+            self._emit(name, 'done', elapsed_s)
+        return None
+
+    async def finish_all_tasks(self):
+        # Await ours first, then collect any others without blocking the loop:
+        with self._pending_lock:
+            futures = [entry[1] for entry in self._pending]
+        await asyncio.gather(*futures, return_exceptions=True)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.scope.finish_all_tasks)
+
+if __name__ == '__main__':
+    async def main():
+        scope = AsyncMicroscope(
+            tbl.Microscope(max_allocated_bytes=10e9, ao_rate=1e5))
+        scope.event_callbacks.append(
+            lambda t_s, name, event, elapsed_s: print(
+                '%0.3f'%t_s, name, event, '%0.3fs'%elapsed_s))
+        await asyncio.gather(
+            scope.epi_apply_settings(
+                epi_channels_per_image=("490_LED",),
+                epi_power_per_channel=(15,),
+                epi_illumination_time_us=1000,
+                epi_height_px=2048,
+                epi_width_px=2048,
+                epi_images_per_buffer=1,
+                ),
+            scope.tbl_apply_settings(
+                tbl_channels_per_image=("488",),
+                tbl_power_per_channel=(15,),
+                tbl_illumination_time_us=1000,
+                tbl_height_px=2048,
+                tbl_width_px=2048,
+                tbl_images_per_buffer=1,
+                ))
+        # Overlap acquisitions with analysis of the returned data:
+        async def acquire_and_measure(acquire):
+            data = await acquire(display=True, return_data=True)
+            mean = data.mean()
+            await scope.release_data(data) # free the data buffer slot
+            return mean
+        means = await asyncio.gather(
+            *[acquire_and_measure(a) for a in
+              (scope.epi_acquire, scope.tbl_acquire) * 2])
+        print('means', means)
+        await scope.finish_all_tasks()
+        await scope.close()
+    asyncio.run(main())
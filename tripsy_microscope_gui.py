@@ -1,5 +1,8 @@
 # Imports from the python standard library:
+import collections
 import os
+import queue
+import threading
 import time
 import tkinter as tk
 from datetime import datetime
@@ -13,11 +16,15 @@ from tifffile import imread, imwrite
 
 # Our code, one .py file per module, copy files to your local directory:
 import tripsy_microscope as tbl
+import tripsy_microscope_server as tbl_server
 import tkinter_compound_widgets as tkcw # github.com/amsikking/tkinter
 
 class GuiMicroscope:
-    def __init__(self, init_microscope=True): # set False for GUI design...
+    def __init__(self,
+                 init_microscope=True,      # set False for GUI design...
+                 use_device_server=False):  # True = attach to a server
         self.init_microscope = init_microscope
+        self.use_device_server = use_device_server
         self.root = tk.Tk()
         self.root.title('Tripsy Microscope GUI')
         # adjust font size and delay:
@@ -57,10 +64,16 @@ class GuiMicroscope:
         # optionally initialize microscope:
         if init_microscope:
             self.max_allocated_bytes = 10e9
-            self.scope = tbl.Microscope(
-                max_allocated_bytes=self.max_allocated_bytes,
-                ao_rate=1e5,
-                print_warnings=False)
+            if use_device_server: # devices stay open between GUI sessions
+                self.scope = tbl_server.attach(
+                    max_allocated_bytes=self.max_allocated_bytes,
+                    ao_rate=1e5,
+                    print_warnings=False)
+            else:
+                self.scope = tbl.Microscope(
+                    max_allocated_bytes=self.max_allocated_bytes,
+                    ao_rate=1e5,
+                    print_warnings=False)
             self.epi_max_bytes_per_buffer = self.scope.epi_max_bytes_per_buffer
             self.tbl_max_bytes_per_buffer = self.scope.epi_max_bytes_per_buffer
             # configure any hardware preferences:
@@ -88,47 +101,32 @@ class GuiMicroscope:
                 tbl_images_per_buffer    = (
                     self.tbl_images_per_buffer.value.get()),
                 ).get_result() # finish
-            # check microscope periodically:
+            # update GUI when the microscope publishes new settings:
+            self.settings_snapshots = queue.Queue()
+            self.scope.subscribe_to_settings(self.settings_snapshots.put)
+            # and when it publishes the statistics of each data buffer:
+            self.frame_stats_queue = queue.Queue()
+            self.scope.subscribe_to_frame_stats(self.frame_stats_queue.put)
+            self.frame_stats = { # time series for the GUI, newest last
+                'epi':collections.deque(maxlen=300),
+                'tbl':collections.deque(maxlen=300)}
             def _run_check_microscope():
-                ## epi:
-                # update attributes:
-                self.scope.epi_apply_settings().get_result()
-                # check memory:
-                self.epi_data_bytes.set(
-                    self.scope.epi_bytes_per_data_buffer)
-                self.epi_data_buffer_exceeded.set(
-                    self.scope.epi_data_buffer_exceeded)
-                self.epi_total_bytes.set(
-                    self.scope.epi_total_bytes)
-                self.epi_total_bytes_exceeded.set(
-                    self.scope.epi_total_bytes_exceeded)
-                # calculate voltages:
-                self.epi_buffer_time_s.set(self.scope.epi_buffer_time_s)
-                self.epi_frames_per_s.set(self.scope.epi_frames_per_s)
-                ## tbl:
-                # update attributes:
-                self.scope.tbl_apply_settings().get_result()
-                # check memory:
-                self.tbl_data_bytes.set(
-                    self.scope.tbl_bytes_per_data_buffer)
-                self.tbl_data_buffer_exceeded.set(
-                    self.scope.tbl_data_buffer_exceeded)
-                self.tbl_total_bytes.set(
-                    self.scope.tbl_total_bytes)
-                self.tbl_total_bytes_exceeded.set(
-                    self.scope.tbl_total_bytes_exceeded)
-                # calculate voltages:
-                self.tbl_buffer_time_s.set(self.scope.tbl_buffer_time_s)
-                self.tbl_frames_per_s.set(self.scope.tbl_frames_per_s)
-                # update GUI highlight:
-                bg_color = '#FFCCCB'
-                if self.scope._epi_enabled:
-                    self.epi_inner_frame.configure(bg=bg_color)
-                    self.tbl_inner_frame.configure(bg='SystemButtonFace')
-                else:
-                    self.epi_inner_frame.configure(bg='SystemButtonFace')
-                    self.tbl_inner_frame.configure(bg=bg_color)
-                self.root.after(int(1e3/10), _run_check_microscope) # 30fps
+                # get the latest snapshot (if any) without blocking:
+                snapshot = None
+                while True:
+                    try:
+                        snapshot = self.settings_snapshots.get_nowait()
+                    except queue.Empty:
+                        break
+                if snapshot is not None:
+                    self._update_settings_output(snapshot)
+                while True:
+                    try:
+                        stats = self.frame_stats_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._update_frame_stats(stats)
+                self.root.after(int(1e3/10), _run_check_microscope) # 10fps
                 return None
             _run_check_microscope()
             # make session folder:
@@ -141,6 +139,50 @@ class GuiMicroscope:
         self.root.mainloop() # blocks here until 'QUIT'
         self.root.destroy()
 
+    def _update_settings_output(self, snapshot):
+        ## epi:
+        # check memory:
+        self.epi_data_bytes.set(snapshot['epi_bytes_per_data_buffer'])
+        self.epi_data_buffer_exceeded.set(snapshot['epi_data_buffer_exceeded'])
+        self.epi_total_bytes.set(snapshot['epi_total_bytes'])
+        self.epi_total_bytes_exceeded.set(snapshot['epi_total_bytes_exceeded'])
+        # calculate voltages:
+        self.epi_buffer_time_s.set(snapshot['epi_buffer_time_s'])
+        self.epi_frames_per_s.set(snapshot['epi_frames_per_s'])
+        ## tbl:
+        # check memory:
+        self.tbl_data_bytes.set(snapshot['tbl_bytes_per_data_buffer'])
+        self.tbl_data_buffer_exceeded.set(snapshot['tbl_data_buffer_exceeded'])
+        self.tbl_total_bytes.set(snapshot['tbl_total_bytes'])
+        self.tbl_total_bytes_exceeded.set(snapshot['tbl_total_bytes_exceeded'])
+        # calculate voltages:
+        self.tbl_buffer_time_s.set(snapshot['tbl_buffer_time_s'])
+        self.tbl_frames_per_s.set(snapshot['tbl_frames_per_s'])
+        # update GUI highlight:
+        bg_color = '#FFCCCB'
+        if snapshot['epi_enabled']:
+            self.epi_inner_frame.configure(bg=bg_color)
+            self.tbl_inner_frame.configure(bg='SystemButtonFace')
+        else:
+            self.epi_inner_frame.configure(bg='SystemButtonFace')
+            self.tbl_inner_frame.configure(bg=bg_color)
+        return None
+
+    def _update_frame_stats(self, stats):
+        path = stats['path']
+        # keep one point per data buffer (lightweight):
+        self.frame_stats[path].append((stats['time_s'],
+                                       float(stats['mean'].mean()),
+                                       int(stats['max'].max()),
+                                       int(stats['saturated'].sum())))
+        t_s, mean, max_counts, saturated = self.frame_stats[path][-1]
+        text = '%0.0f / %i / %i'%(mean, max_counts, saturated)
+        if path == 'epi':
+            self.epi_frame_stats.set(text)
+        else:
+            self.tbl_frame_stats.set(text)
+        return None
+
     def epi_init_led(self, epi_frame):
         frame = tk.LabelFrame(epi_frame, text='LED', bd=6)
         frame.grid(row=0, column=0, rowspan=1, padx=5, pady=5, sticky='n')
@@ -496,6 +538,29 @@ class GuiMicroscope:
             'write',
             lambda var, index, mode: _update_epi_min_time())
         epi_min_time_textbox_tip = Hovertip(epi_min_time_textbox, "tip...")
+        # frame statistics textbox:
+        self.epi_frame_stats = tk.StringVar()
+        epi_frame_stats_textbox = tkcw.Textbox(
+            frame,
+            label='Last frame mean / max / saturated',
+            default_text='None',
+            row=5,
+            width=spinbox_width,
+            height=1)
+        epi_frame_stats_textbox.textbox.tag_add('color', '1.0', 'end')
+        def _update_epi_frame_stats():
+            text = self.epi_frame_stats.get()
+            epi_frame_stats_textbox.textbox.delete('1.0', 'end')
+            bg = 'white'
+            if int(text.split(' / ')[-1]) > 0: bg = 'red' # saturated
+            epi_frame_stats_textbox.textbox.tag_config('color', background=bg)
+            epi_frame_stats_textbox.textbox.insert('1.0', text, 'color')
+            return None
+        self.epi_frame_stats.trace_add(
+            'write',
+            lambda var, index, mode: _update_epi_frame_stats())
+        epi_frame_stats_textbox_tip = Hovertip(
+            epi_frame_stats_textbox, "tip...")
         return None
 
     def epi_init_acquire(self, epi_frame):
@@ -571,38 +636,57 @@ class GuiMicroscope:
             self._set_running_mode('epi_acquire')
             self.folder_name = self._epi_get_folder_name() + '_acquire'
             self.delay_saved = False
-            self.acquire_count = 0
-            def _run_acquire():
-                if not self.epi_running_acquire.get(): # check for cancel
+            # check the disk can hold and keep up with the run (measuring
+            # a new folder's write speed takes seconds, so not on Tk):
+            def _start_time_lapse(plan):
+                if plan['verdict'] == "refuse":
+                    print('Acquire -> refused (%s)\n'%plan['reason'])
+                    self._set_running_mode('None')
                     return None
-                # don't launch all tasks: either wait 1 buffer time or delay:
-                wait_ms = int(round(1e3 * self.scope.epi_buffer_time_s))
-                self.scope.epi_acquire(
-                    filename='%06i.tif'%self.acquire_count,
+                if plan['verdict'] == "throttle": # slow down to the disk
+                    print('Acquire -> throttled (%s)'%plan['reason'])
+                    self.epi_delay_s.update_and_validate(
+                        int(np.ceil(plan['delay_s'])))
+                # the microscope paces the acquires, the GUI only starts/stops:
+                self.time_lapse = self.scope.epi_time_lapse(
+                    acquire_number=self.epi_acquire_number.value.get(),
+                    delay_s=self.epi_delay_s.value.get(),
                     folder_name=self.folder_name,
-                    description=self.epi_description_textbox.text)
-                self.acquire_count += 1
-                if self.epi_delay_s.value.get() > self.scope.epi_buffer_time_s:
-                    wait_ms = int(round(1e3 * self.epi_delay_s.value.get()))                    
-                # record gui delay:
-                if (not self.delay_saved and os.path.exists(
-                    self.folder_name)):
-                    with open(self.folder_name + '\\'  "gui_delay_s.txt",
-                              "w") as file:
-                        file.write(self.folder_name + '\n')
-                        file.write(
-                            'gui_delay_s: %i'%self.epi_delay_s.value.get() +
-                            '\n')
-                        self.delay_saved = True
-                # check acquire count before re-run:
-                if self.acquire_count < self.epi_acquire_number.value.get():
-                    self.root.after(wait_ms, _run_acquire)
-                else:
-                    self.scope.finish_all_tasks()
-                    self._set_running_mode('None')
-                    print('Acquire -> finished\n')
+                    description=self.epi_description_textbox.text,
+                    priority='background') # snaps and settings go first
+                def _run_acquire():
+                    if not self.epi_running_acquire.get(): # check for cancel
+                        self.time_lapse.stop()
+                        return None
+                    # record gui delay:
+                    if (not self.delay_saved and os.path.exists(
+                        self.folder_name)):
+                        with open(self.folder_name + '\\'  "gui_delay_s.txt",
+                                  "w") as file:
+                            file.write(self.folder_name + '\n')
+                            file.write('gui_delay_s: %i\n'%(
+                                self.epi_delay_s.value.get()))
+                            self.delay_saved = True
+                    # check the time lapse before re-run:
+                    if self.time_lapse.is_alive():
+                        self.root.after(int(1e3/10), _run_acquire)
+                    else:
+                        self.scope.finish_all_tasks()
+                        self._set_running_mode('None')
+                        print('Acquire -> finished (jitter: %s)'%(
+                            self.time_lapse.jitter_stats()))
+                        print('Acquire -> queue waits: %s\n'%(
+                            self.scope.queue_wait_stats()))
+                    return None
+                _run_acquire()
                 return None
-            _run_acquire()
+            self._plan_storage(
+                'epi',
+                self.epi_acquire_number.value.get(),
+                self.epi_delay_s.value.get(),
+                self.folder_name,
+                self.epi_running_acquire,
+                _start_time_lapse)
             return None
         self.epi_running_acquire = tk.BooleanVar()
         acquire_button = tk.Checkbutton(
@@ -617,6 +701,61 @@ class GuiMicroscope:
             height=button_height)
         acquire_button.grid(row=4, column=0, padx=10, pady=10)
         acquire_button_tip = Hovertip(acquire_button, "tip...")
+        # recent acquires (replay from RAM, no file reading):
+        recent_frame = tk.Frame(self.epi_inner_frame)
+        recent_frame.grid(row=5, column=0, padx=10, pady=10)
+        self.epi_recent_index = 0 # 0 = newest
+        self.epi_recent_newest = None # reset the index when this changes
+        recent_label = tk.Label(recent_frame, text='Recent: None')
+        recent_label.grid(row=0, column=0, columnspan=2)
+        def _show_recent(step): # step back (+1) or forward (-1) in time
+            recent = self.scope.recent_acquires('epi')
+            if len(recent) == 0:
+                recent_label.config(text='Recent: None')
+                return None
+            if recent[-1]['number'] != self.epi_recent_newest:
+                self.epi_recent_newest = recent[-1]['number'] # new acquire
+                self.epi_recent_index = 0
+                step = 0 # show the newest first
+            self.epi_recent_index = min(
+                max(self.epi_recent_index + step, 0), len(recent) - 1)
+            entry = recent[-1 - self.epi_recent_index]
+            self.scope.display_recent('epi', entry['number'])
+            recent_label.config(text='Recent: %i of %i (%s)'%(
+                self.epi_recent_index + 1, len(recent), entry['time']))
+            return None
+        prev_button = tk.Button(
+            recent_frame,
+            text="< Prev",
+            command=lambda: _show_recent(1),
+            width=button_width // 2)
+        prev_button.grid(row=1, column=0)
+        prev_button_tip = Hovertip(prev_button, "tip...")
+        next_button = tk.Button(
+            recent_frame,
+            text="Next >",
+            command=lambda: _show_recent(-1),
+            width=button_width // 2)
+        next_button.grid(row=1, column=1)
+        next_button_tip = Hovertip(next_button, "tip...")
+        # waveform inspector (plots here, also when attached to a server):
+        def _plot_voltages():
+            voltages = self.scope.epi_voltages
+            tbl.plot_voltages(
+                voltages,
+                self.scope.epi_buffer_time_s / voltages.shape[0],
+                self.scope.names_to_voltage_channels,
+                title='epi voltages',
+                block=False)
+            return None
+        plot_button = tk.Button(
+            self.epi_inner_frame,
+            text="Plot voltages",
+            command=_plot_voltages,
+            width=button_width,
+            height=button_height)
+        plot_button.grid(row=6, column=0, padx=10, pady=10)
+        plot_button_tip = Hovertip(plot_button, "tip...")
         return None
 
     def tbl_init_lasers(self, tbl_frame):
@@ -1039,6 +1178,29 @@ class GuiMicroscope:
             'write',
             lambda var, index, mode: _update_tbl_min_time())
         tbl_min_time_textbox_tip = Hovertip(tbl_min_time_textbox, "tip...")
+        # frame statistics textbox:
+        self.tbl_frame_stats = tk.StringVar()
+        tbl_frame_stats_textbox = tkcw.Textbox(
+            frame,
+            label='Last frame mean / max / saturated',
+            default_text='None',
+            row=5,
+            width=spinbox_width,
+            height=1)
+        tbl_frame_stats_textbox.textbox.tag_add('color', '1.0', 'end')
+        def _update_tbl_frame_stats():
+            text = self.tbl_frame_stats.get()
+            tbl_frame_stats_textbox.textbox.delete('1.0', 'end')
+            bg = 'white'
+            if int(text.split(' / ')[-1]) > 0: bg = 'red' # saturated
+            tbl_frame_stats_textbox.textbox.tag_config('color', background=bg)
+            tbl_frame_stats_textbox.textbox.insert('1.0', text, 'color')
+            return None
+        self.tbl_frame_stats.trace_add(
+            'write',
+            lambda var, index, mode: _update_tbl_frame_stats())
+        tbl_frame_stats_textbox_tip = Hovertip(
+            tbl_frame_stats_textbox, "tip...")
         return None
 
     def tbl_init_acquire(self, tbl_frame):
@@ -1114,38 +1276,57 @@ class GuiMicroscope:
             self._set_running_mode('tbl_acquire')
             self.folder_name = self._tbl_get_folder_name() + '_acquire'
             self.delay_saved = False
-            self.acquire_count = 0
-            def _run_acquire():
-                if not self.tbl_running_acquire.get(): # check for cancel
+            # check the disk can hold and keep up with the run (measuring
+            # a new folder's write speed takes seconds, so not on Tk):
+            def _start_time_lapse(plan):
+                if plan['verdict'] == "refuse":
+                    print('Acquire -> refused (%s)\n'%plan['reason'])
+                    self._set_running_mode('None')
                     return None
-                # don't launch all tasks: either wait 1 buffer time or delay:
-                wait_ms = int(round(1e3 * self.scope.tbl_buffer_time_s))
-                self.scope.tbl_acquire(
-                    filename='%06i.tif'%self.acquire_count,
+                if plan['verdict'] == "throttle": # slow down to the disk
+                    print('Acquire -> throttled (%s)'%plan['reason'])
+                    self.tbl_delay_s.update_and_validate(
+                        int(np.ceil(plan['delay_s'])))
+                # the microscope paces the acquires, the GUI only starts/stops:
+                self.time_lapse = self.scope.tbl_time_lapse(
+                    acquire_number=self.tbl_acquire_number.value.get(),
+                    delay_s=self.tbl_delay_s.value.get(),
                     folder_name=self.folder_name,
-                    description=self.tbl_description_textbox.text)
-                self.acquire_count += 1
-                if self.tbl_delay_s.value.get() > self.scope.tbl_buffer_time_s:
-                    wait_ms = int(round(1e3 * self.tbl_delay_s.value.get()))                    
-                # record gui delay:
-                if (not self.delay_saved and os.path.exists(
-                    self.folder_name)):
-                    with open(self.folder_name + '\\'  "gui_delay_s.txt",
-                              "w") as file:
-                        file.write(self.folder_name + '\n')
-                        file.write(
-                            'gui_delay_s: %i'%self.tbl_delay_s.value.get() +
-                            '\n')
-                        self.delay_saved = True
-                # check acquire count before re-run:
-                if self.acquire_count < self.tbl_acquire_number.value.get():
-                    self.root.after(wait_ms, _run_acquire)
-                else:
-                    self.scope.finish_all_tasks()
-                    self._set_running_mode('None')
-                    print('Acquire -> finished\n')
+                    description=self.tbl_description_textbox.text,
+                    priority='background') # snaps and settings go first
+                def _run_acquire():
+                    if not self.tbl_running_acquire.get(): # check for cancel
+                        self.time_lapse.stop()
+                        return None
+                    # record gui delay:
+                    if (not self.delay_saved and os.path.exists(
+                        self.folder_name)):
+                        with open(self.folder_name + '\\'  "gui_delay_s.txt",
+                                  "w") as file:
+                            file.write(self.folder_name + '\n')
+                            file.write('gui_delay_s: %i\n'%(
+                                self.tbl_delay_s.value.get()))
+                            self.delay_saved = True
+                    # check the time lapse before re-run:
+                    if self.time_lapse.is_alive():
+                        self.root.after(int(1e3/10), _run_acquire)
+                    else:
+                        self.scope.finish_all_tasks()
+                        self._set_running_mode('None')
+                        print('Acquire -> finished (jitter: %s)'%(
+                            self.time_lapse.jitter_stats()))
+                        print('Acquire -> queue waits: %s\n'%(
+                            self.scope.queue_wait_stats()))
+                    return None
+                _run_acquire()
                 return None
-            _run_acquire()
+            self._plan_storage(
+                'tbl',
+                self.tbl_acquire_number.value.get(),
+                self.tbl_delay_s.value.get(),
+                self.folder_name,
+                self.tbl_running_acquire,
+                _start_time_lapse)
             return None
         self.tbl_running_acquire = tk.BooleanVar()
         acquire_button = tk.Checkbutton(
@@ -1160,6 +1341,61 @@ class GuiMicroscope:
             height=button_height)
         acquire_button.grid(row=4, column=0, padx=10, pady=10)
         acquire_button_tip = Hovertip(acquire_button, "tip...")
+        # recent acquires (replay from RAM, no file reading):
+        recent_frame = tk.Frame(self.tbl_inner_frame)
+        recent_frame.grid(row=5, column=0, padx=10, pady=10)
+        self.tbl_recent_index = 0 # 0 = newest
+        self.tbl_recent_newest = None # reset the index when this changes
+        recent_label = tk.Label(recent_frame, text='Recent: None')
+        recent_label.grid(row=0, column=0, columnspan=2)
+        def _show_recent(step): # step back (+1) or forward (-1) in time
+            recent = self.scope.recent_acquires('tbl')
+            if len(recent) == 0:
+                recent_label.config(text='Recent: None')
+                return None
+            if recent[-1]['number'] != self.tbl_recent_newest:
+                self.tbl_recent_newest = recent[-1]['number'] # new acquire
+                self.tbl_recent_index = 0
+                step = 0 # show the newest first
+            self.tbl_recent_index = min(
+                max(self.tbl_recent_index + step, 0), len(recent) - 1)
+            entry = recent[-1 - self.tbl_recent_index]
+            self.scope.display_recent('tbl', entry['number'])
+            recent_label.config(text='Recent: %i of %i (%s)'%(
+                self.tbl_recent_index + 1, len(recent), entry['time']))
+            return None
+        prev_button = tk.Button(
+            recent_frame,
+            text="< Prev",
+            command=lambda: _show_recent(1),
+            width=button_width // 2)
+        prev_button.grid(row=1, column=0)
+        prev_button_tip = Hovertip(prev_button, "tip...")
+        next_button = tk.Button(
+            recent_frame,
+            text="Next >",
+            command=lambda: _show_recent(-1),
+            width=button_width // 2)
+        next_button.grid(row=1, column=1)
+        next_button_tip = Hovertip(next_button, "tip...")
+        # waveform inspector (plots here, also when attached to a server):
+        def _plot_voltages():
+            voltages = self.scope.tbl_voltages
+            tbl.plot_voltages(
+                voltages,
+                self.scope.tbl_buffer_time_s / voltages.shape[0],
+                self.scope.names_to_voltage_channels,
+                title='tbl voltages',
+                block=False)
+            return None
+        plot_button = tk.Button(
+            self.tbl_inner_frame,
+            text="Plot voltages",
+            command=_plot_voltages,
+            width=button_width,
+            height=button_height)
+        plot_button.grid(row=6, column=0, padx=10, pady=10)
+        plot_button_tip = Hovertip(plot_button, "tip...")
         return None
 
     def init_exit(self):
@@ -1167,7 +1403,7 @@ class GuiMicroscope:
             self.root, text='EXIT', font=('Segoe UI', '10', 'bold'), bd=6)
         frame.grid(row=5, column=0, columnspan=2, padx=5, pady=5)
         def _exit():
-            if self.init_microscope: self.scope.close()
+            if self.init_microscope: self.scope.close() # server: detach only
             self.root.quit()
             return None
         exit_button = tk.Button(
@@ -1215,6 +1451,35 @@ class GuiMicroscope:
             "once launched.")
         return None
 
+    def _plan_storage(self, path, acquire_number, delay_s, folder_name,
+                      running, callback):
+        # 'scope.plan_storage' in a thread, then 'callback(plan)' on the Tk
+        # thread (unless cancelled with the 'running' variable meanwhile):
+        print('Acquire -> checking storage...')
+        results = queue.Queue()
+        def _plan():
+            try:
+                results.put(self.scope.plan_storage(
+                    path, acquire_number, delay_s, folder_name))
+            except Exception as e:
+                results.put(e)
+            return None
+        threading.Thread(target=_plan, daemon=True).start()
+        def _check_plan():
+            if results.empty():
+                self.root.after(int(1e3/10), _check_plan)
+                return None
+            plan = results.get()
+            if isinstance(plan, Exception) or not running.get():
+                print('Acquire -> cancelled (%s)\n'%(
+                    plan if isinstance(plan, Exception) else 'by user'))
+                self._set_running_mode('None')
+                return None
+            callback(plan)
+            return None
+        _check_plan()
+        return None
+
     def _set_running_mode(self, mode):
         if mode != 'None':
             # turn everything off except current mode:
@@ -0,0 +1,487 @@
+# Imports from the python standard library:
+import argparse
+import collections
+import getpass
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import types
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# Third party imports, installable via pip:
+import numpy as np
+
+# Our code, one .py file per module, copy files to your local directory:
+import tripsy_microscope as tbl
+
+# Local only: a named pipe on Windows, a unix domain socket elsewhere. The
+# socket and a random authkey live in a folder only this user can read, so
+# other users can't connect (None = this per-user default):
+default_address = None
+default_authkey = None
+
+# What clients may call ('multiprocessing.connection' pickles, so only
+# expose the control API, never the devices or arbitrary attributes):
+allowed_calls = (
+    'epi_apply_settings', 'tbl_apply_settings',
+    'epi_acquire', 'tbl_acquire',
+    'epi_acquire_series', 'tbl_acquire_series',
+    'epi_time_lapse', 'tbl_time_lapse',
+    'epi_calibrate', 'tbl_calibrate',
+    'epi_calibrate_jitter', 'tbl_calibrate_jitter',
+    'acquire_many',
+    'finish_all_tasks',
+    'task_errors',
+    'task_stats',
+    'queue_wait_stats',
+    'memory_report',
+    'measure_write_bandwidth',
+    'plan_storage',
+    'plan_settings',
+    'largest_height_px',
+    'recent_acquires',
+    'get_recent',
+    'display_recent',
+    'display_saved',
+    )
+allowed_task_calls = ('get_result', 'is_alive', 'stop', 'jitter_stats')
+hidden_attributes = ( # devices and internals (public names, not for clients)
+    'epi_camera', 'tbl_camera', 'ao', 'display', 'filter_wheel', 'laser_box',
+    'unfinished_tasks', 'processors', 'recent', 'calibrations')
+
+def _user_folder(): # created private (0700), and must stay private
+    if sys.platform == 'win32':
+        folder = os.path.join(os.environ.get(
+            'LOCALAPPDATA', os.path.expanduser('~')), 'tripsy_microscope')
+    else:
+        folder = os.path.join(os.path.expanduser('~'), '.tripsy_microscope')
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if sys.platform != 'win32':
+        status = os.stat(folder)
+        if status.st_uid != os.getuid() or status.st_mode & 0o077:
+            raise PermissionError(
+                "Device server: '%s' must be private (chmod 700)"%folder)
+    return folder
+
+def _default_address():
+    if sys.platform == 'win32':
+        return r'\\.\pipe\tripsy_microscope_' + getpass.getuser()
+    return os.path.join(_user_folder(), 'server.sock')
+
+def _load_authkey(create=False): # 'create' is for the server
+    path = os.path.join(_user_folder(), 'authkey')
+    if create and not os.path.exists(path):
+        try: # readable by this user only (0600)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError: # another server just made one
+            pass
+        else:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(os.urandom(32))
+    with open(path, 'rb') as file:
+        return file.read()
+
+class DeviceServer:
+    # Owns the 'tbl.Microscope' (and so all the 'ObjectInSubprocess' devices)
+    # in a long-lived process. GUI and script sessions attach with 'attach()'
+    # and get a 'MicroscopeClient', so restarting them skips hardware init
+    # and keeps the armed state of the devices.
+    # The control API is the 'tbl.Microscope' API ('epi_apply_settings',
+    # 'tbl_apply_settings', '*_acquire', 'finish_all_tasks'..., only what's
+    # in 'allowed_calls'). Data from '*_acquire(return_data=True)' is sent
+    # as a shared memory name, and the client maps the same memory, so no
+    # pixels are copied.
+    def __init__(self,
+                 address=default_address,
+                 authkey=default_authkey,
+                 max_tasks=1000,        # finished tasks are forgotten beyond
+                 max_frames=16,         # warn if more are waiting to map
+                 verbose=True,
+                 **microscope_kwargs):  # passed to 'tbl.Microscope'
+        self.verbose = verbose
+        self.max_tasks = max_tasks
+        self.max_frames = max_frames
+        if address is None: address = _default_address()
+        if authkey is None: authkey = _load_authkey(create=True)
+        self.address = address
+        self.authkey = authkey # also to wake 'serve_forever', see '_shutdown'
+        if self.verbose: print("Device server: opening microscope...")
+        self.scope = tbl.Microscope(verbose=verbose, **microscope_kwargs)
+        self.tasks = {} # task id -> thread (or other object with get_result)
+        self._task_ids = itertools.count()
+        self._tasks_lock = threading.Lock()
+        self.frames = {} # shared memory name -> array, until mapped
+        self._frames_lock = threading.Lock()
+        self._settings_changed = threading.Condition()
+        self.scope.subscribe_to_settings(self._notify_settings_changed)
+        self.frame_stats = collections.deque(maxlen=100) # (number, stats)
+        self._frame_stats_numbers = itertools.count()
+        self._frame_stats_changed = threading.Condition()
+        self.scope.subscribe_to_frame_stats(self._add_frame_stats)
+        if sys.platform != 'win32' and os.path.exists(address):
+            os.remove(address) # stale socket from a server that crashed
+        self.listener = Listener(address, authkey=authkey)
+        self._running = True
+        if self.verbose: print("Device server: -> listening on", address)
+
+    def _notify_settings_changed(self, snapshot):
+        with self._settings_changed:
+            self._settings_changed.notify_all()
+        return None
+
+    def _add_frame_stats(self, stats):
+        with self._frame_stats_changed:
+            self.frame_stats.append((next(self._frame_stats_numbers), stats))
+            self._frame_stats_changed.notify_all()
+        return None
+
+    def serve_forever(self): # blocks until a client calls 'shutdown'
+        while self._running:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError): # bad client
+                continue
+            if not self._running: # woken up by '_shutdown'
+                connection.close()
+                break
+            threading.Thread(
+                target=self._serve_client, args=(connection,),
+                daemon=True).start()
+        self.listener.close() # here, closing from another thread doesn't
+        return None           # wake 'accept' (unix domain sockets)
+
+    def _serve_client(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError): # client detached
+                    return None
+                try:
+                    reply = self._handle(*request)
+                except Exception as e:
+                    reply = ('error', e)
+                try:
+                    connection.send(reply)
+                except Exception as e: # e.g. unpicklable exception
+                    connection.send(('error', RuntimeError(repr(e))))
+                if request[0] == 'shutdown':
+                    self._shutdown()
+                    return None
+
+    def _handle(self, command, *args):
+        if command == 'ping':
+            return ('value', None)
+        if command == 'getattr':
+            (name,) = args
+            if name.startswith('_') or name in hidden_attributes:
+                raise PermissionError("Device server: '%s' is private"%name)
+            value = getattr(self.scope, name)
+            if callable(value) and name not in allowed_calls:
+                raise PermissionError(
+                    "Device server: '%s' is not in 'allowed_calls'"%name)
+            return self._encode(value, share=False) # e.g. '*_voltages'
+        if command == 'call':
+            name, call_args, call_kwargs = args
+            if name not in allowed_calls:
+                raise PermissionError(
+                    "Device server: '%s' is not in 'allowed_calls'"%name)
+            return self._encode(
+                getattr(self.scope, name)(*call_args, **call_kwargs))
+        if command == 'task_call':
+            task_id, name, call_args, call_kwargs = args
+            if name not in allowed_task_calls:
+                raise PermissionError(
+                    "Device server: '%s' is not a task call"%name)
+            task = self.tasks[task_id]
+            return self._encode(getattr(task, name)(*call_args, **call_kwargs))
+        if command == 'wait_for_settings':
+            version, timeout_s = args
+            def changed():
+                snapshot = self.scope.settings_snapshot
+                return snapshot is not None and snapshot['version'] != version
+            with self._settings_changed:
+                self._settings_changed.wait_for(changed, timeout_s)
+            return self._encode(self.scope.settings_snapshot)
+        if command == 'wait_for_frame_stats': # newer than 'number'
+            number, timeout_s = args
+            def newer():
+                return [(n, s) for n, s in self.frame_stats if n > number]
+            with self._frame_stats_changed:
+                self._frame_stats_changed.wait_for(newer, timeout_s)
+                return ('value', newer())
+        if command == 'frame_mapped': # the client holds it, we can let go
+            (name,) = args
+            with self._frames_lock:
+                self.frames.pop(name, None)
+            return ('value', None)
+        if command == 'release_data': # client is done, free the slot
+            (name,) = args
+            self.scope.release_data(name)
+            return ('value', None)
+        if command == 'shutdown':
+            return ('value', None)
+        raise ValueError("Device server: unknown command '%s'"%command)
+
+    def _encode(self, value, share=True):
+        # Threads and methods stay here, the client gets a handle instead.
+        # Shared memory is only mapped for data calls return (the client
+        # releases it), attributes are small so they're copied:
+        if hasattr(value, 'get_result') and hasattr(value, 'is_alive'):
+            return ('task', self._add_task(value))
+        if isinstance(value, np.ndarray) and hasattr(value, 'shared_memory'):
+            if not share:
+                return ('value', np.array(value))
+            return ('frame', self._add_frame(value))
+        if callable(value):
+            return ('method', None)
+        if isinstance(value, types.MappingProxyType): # settings snapshot
+            return ('value', dict(value))
+        if isinstance(value, (list, tuple)) and any(
+            hasattr(v, 'get_result') for v in value):
+            return ('list', [self._encode(v) for v in value])
+        return ('value', value)
+
+    def _add_task(self, task):
+        with self._tasks_lock:
+            task_id = next(self._task_ids)
+            self.tasks[task_id] = task
+            if len(self.tasks) > self.max_tasks: # forget the oldest finished
+                for old_id in list(self.tasks):
+                    if not self.tasks[old_id].is_alive():
+                        del self.tasks[old_id]
+                        if len(self.tasks) <= self.max_tasks:
+                            break
+        return task_id
+
+    def _add_frame(self, frame): # 'ct.SharedNDArray' (or a view of one)
+        frame_info = tbl._shared_memory_info(frame)
+        with self._frames_lock: # keep it alive until the client maps it
+            self.frames[frame_info[0]] = frame # (never dropped before that)
+            waiting = len(self.frames)
+        if waiting > self.max_frames and self.verbose:
+            print("Device server: ***WARNING***: %i frames not mapped"%(
+                waiting), "by clients yet")
+        return frame_info
+
+    def _shutdown(self):
+        if self.verbose: print("Device server: shutting down...")
+        self._running = False
+        self.scope.close()
+        try: # wake 'serve_forever' from 'accept', it closes the listener
+            Client(self.address, authkey=self.authkey).close()
+        except OSError: # already closed
+            pass
+        if self.verbose: print("Device server: -> done.")
+        return None
+
+class MicroscopeClient:
+    # Looks like a 'tbl.Microscope': attributes are read from the server,
+    # methods run there, and returned threads become '_RemoteTask' handles.
+    # 'close()' only detaches; use 'shutdown()' to close the devices.
+    def __init__(self, address=default_address, authkey=default_authkey):
+        if address is None: address = _default_address()
+        if authkey is None: authkey = _load_authkey() # no key = no server
+        self._address = address
+        self._authkey = authkey
+        self._connections = queue.LifoQueue() # one per concurrent request
+        self._subscribers = []
+        self._frames = {} # id(frame) -> shared memory
+        self._frames_lock = threading.Lock()
+        self._request('ping')
+
+    def _request(self, *request):
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = Client(self._address, authkey=self._authkey)
+        connection.send(request)
+        reply = connection.recv()
+        self._connections.put(connection)
+        return self._decode(reply, request)
+
+    def _decode(self, reply, request):
+        kind, value = reply
+        if kind == 'error':
+            raise value
+        if kind == 'task':
+            return _RemoteTask(self, value)
+        if kind == 'frame':
+            return self._map_frame(*value)
+        if kind == 'method':
+            name = request[1]
+            def method(*args, **kwargs):
+                return self._request('call', name, args, kwargs)
+            return method
+        if kind == 'list':
+            return [self._decode(v, request) for v in value]
+        if isinstance(value, dict) and 'version' in value: # settings snapshot
+            return types.MappingProxyType(value)
+        return value
+
+    def _map_frame(self, name, shape, dtype, offset, strides):
+        frame, memory = tbl._map_shared_memory(
+            name, shape, dtype, offset, strides)
+        with self._frames_lock:
+            self._frames[id(frame)] = (memory, name)
+        self._request('frame_mapped', name) # server can let go
+        return frame
+
+    def release_frame(self, frame): # call when done with an acquired frame
+        with self._frames_lock:
+            memory, name = self._frames.pop(id(frame))
+        del frame
+        try:
+            memory.close()
+        except BufferError: # caller still holds a view, let gc close it
+            pass
+        self._request('release_data', name) # free the data buffer slot
+        return None
+
+    release_data = release_frame # same name as 'tbl.Microscope'
+
+    def __getattr__(self, name): # only called for non-local attributes
+        if name.startswith('__') or name in (
+            '_address', '_authkey', '_connections', '_subscribers', '_frames',
+            '_frames_lock'):
+            raise AttributeError(name) # e.g. if '__init__' failed
+        return self._request('getattr', name)
+
+    def subscribe_to_settings(self, callback):
+        # Each subscriber waits for new snapshots on its own connection:
+        self._subscribers.append(callback)
+        def wait_for_settings():
+            version = None
+            while callback in self._subscribers:
+                try:
+                    snapshot = self._request(
+                        'wait_for_settings', version, 1) # 1s timeout
+                except (EOFError, OSError): # server gone
+                    return None
+                if snapshot is not None and snapshot['version'] != version:
+                    version = snapshot['version']
+                    callback(snapshot)
+            return None
+        threading.Thread(target=wait_for_settings, daemon=True).start()
+        return None
+
+    def unsubscribe_from_settings(self, callback):
+        self._subscribers.remove(callback)
+        return None
+
+    def subscribe_to_frame_stats(self, callback):
+        # Like 'subscribe_to_settings', stats missed while busy are skipped
+        # if more than the server keeps ('DeviceServer.frame_stats'):
+        self._subscribers.append(callback)
+        def wait_for_frame_stats():
+            number = -1
+            while callback in self._subscribers:
+                try:
+                    new = self._request(
+                        'wait_for_frame_stats', number, 1) # 1s timeout
+                except (EOFError, OSError): # server gone
+                    return None
+                for number, stats in new:
+                    callback(stats)
+            return None
+        threading.Thread(target=wait_for_frame_stats, daemon=True).start()
+        return None
+
+    def unsubscribe_from_frame_stats(self, callback):
+        self._subscribers.remove(callback)
+        return None
+
+    def close(self): # detach, the devices stay open in the server
+        self._subscribers.clear()
+        with self._frames_lock: # frames we never released
+            held = list(self._frames.values())
+            self._frames.clear()
+        for memory, name in held:
+            try:
+                self._request('release_data', name)
+            except (EOFError, OSError): # server gone
+                break
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
+        return None
+
+    def shutdown(self): # close the devices and stop the server
+        self._request('shutdown')
+        self.close()
+        return None
+
+class _RemoteTask:
+    # Handle for a thread (or 'TimeLapse') that lives in the server:
+    def __init__(self, client, task_id):
+        self._client = client
+        self._task_id = task_id
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_client', '_task_id'):
+            raise AttributeError(name)
+        def method(*args, **kwargs):
+            return self._client._request(
+                'task_call', self._task_id, name, args, kwargs)
+        return method
+
+def attach(address=default_address,
+           authkey=default_authkey,
+           launch=True,             # start a server if none is running
+           timeout_s=60,            # hardware init can take a while
+           **microscope_kwargs):    # max_allocated_bytes, ao_rate,
+                                    # print_warnings and display (if a
+                                    # server is launched)
+    try:
+        return MicroscopeClient(address, authkey)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if not launch:
+            raise
+    args = [sys.executable, os.path.abspath(__file__)]
+    if address is not None:
+        args.extend(['--address', address])
+    if authkey is not None: # on stdin, not the (visible) command line
+        args.append('--authkey_from_stdin')
+    for k, v in microscope_kwargs.items():
+        args.extend(['--' + k, repr(v)])
+    server = subprocess.Popen(args, stdin=subprocess.PIPE)
+    if authkey is not None:
+        server.stdin.write(authkey.hex().encode() + b'\n')
+    server.stdin.close()
+    t0 = time.perf_counter()
+    while True:
+        try:
+            return MicroscopeClient(address, authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.perf_counter() - t0 > timeout_s:
+                raise TimeoutError(
+                    "Device server: not listening after %ss"%timeout_s)
+            time.sleep(0.1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', default=default_address)
+    parser.add_argument('--authkey_from_stdin', action='store_true')
+    parser.add_argument('--max_allocated_bytes', type=float, default=10e9)
+    parser.add_argument('--ao_rate', type=float, default=1e5)
+    parser.add_argument('--print_warnings', default='True')
+    parser.add_argument('--display', default='True')
+    args = parser.parse_args()
+    authkey = default_authkey
+    if args.authkey_from_stdin: # see 'attach'
+        authkey = bytes.fromhex(sys.stdin.readline().strip())
+    server = DeviceServer(
+        address=args.address,
+        authkey=authkey,
+        max_allocated_bytes=args.max_allocated_bytes,
+        ao_rate=args.ao_rate,
+        print_warnings=(args.print_warnings == 'True'),
+        display=(args.display == 'True'))
+    server.serve_forever()